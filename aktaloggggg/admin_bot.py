@@ -1,13 +1,25 @@
 
 import os
+import atexit
 import logging
+import logging.handlers
+import queue
+import re
 import shutil
-from datetime import datetime, timedelta
+import tempfile
+import threading
+import time
+import weakref
+from datetime import date, datetime, timedelta
 from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache, wraps
+from cachetools.func import ttl_cache
 import sqlite3
-from telegram import Update, Bot, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from telegram import Update, Bot, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from telegram.ext import (
     ApplicationBuilder,
+    BaseUpdateProcessor,
     CommandHandler,
     ConversationHandler,
     MessageHandler,
@@ -15,7 +27,7 @@ from telegram.ext import (
     filters,
     CallbackQueryHandler,
 )
-from telegram.error import BadRequest, Conflict, TelegramError
+from telegram.error import BadRequest, Conflict, RetryAfter, TelegramError
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 from dotenv import load_dotenv
@@ -26,19 +38,50 @@ import asyncio
 load_dotenv()
 
 # --- Logging ---
+# Records are formatted by the QueueHandler and written by a listener thread,
+# so file and console I/O never runs on the event loop.
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(
+    log_queue,
+    logging.FileHandler('admin_bot.log'),
+    logging.StreamHandler()
+)
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG,
-    handlers=[
-        logging.FileHandler('admin_bot.log'),
-        logging.StreamHandler()
-    ]
+    level=logging.INFO,
+    handlers=[logging.handlers.QueueHandler(log_queue)]
 )
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # Enable debug logging for ConversationHandler
 logging.getLogger('telegram.ext.ConversationHandler').setLevel(logging.DEBUG)
 
+# --- Conversation Data ---
+@dataclass(slots=True)
+class AddProductState:
+    """Fields collected by the add-product conversation."""
+    category_id: int | None = None
+    prod_name: str | None = None
+    prod_desc: str | None = None
+    prod_size: str | None = None
+    prod_material: str | None = None
+    prod_price: float | None = None
+
+    def is_complete(self) -> bool:
+        return None not in (
+            self.category_id, self.prod_name, self.prod_desc, self.prod_size, self.prod_material, self.prod_price
+        )
+
+@dataclass(slots=True)
+class AddPromoCodeState:
+    """Fields collected by the add-promo-code conversation."""
+    code: str | None = None
+    product_id: int | None = None
+    discount: int | None = None
+    start_date: str | None = None
+
 # --- States ---
 CATEGORY_CHOICE, NEW_CATEGORY, PROD_NAME, PROD_DESC, PROD_SIZE, PROD_MATERIAL, PROD_PRICE, PROD_PHOTO = range(8)
 PROMO_NAME, PROMO_DESC, PROMO_IMAGE, PROMO_START, PROMO_END = range(5)
@@ -46,7 +89,7 @@ PROMO_CODE, PROMO_PRODUCT, PROMO_DISCOUNT, PROMO_CODE_START, PROMO_CODE_END = ra
 MAIL_CONTENT, MAIL_TIMER = range(2)
 
 # --- Environment configuration ---
-ADMIN_IDS = {int(x) for x in os.getenv('ADMIN_IDS', '').split(',') if x}
+ADMIN_IDS = frozenset(int(x) for x in os.getenv('ADMIN_IDS', '').split(',') if x.strip())
 CREDENTIALS_PATH = os.getenv('GOOGLE_CREDENTIALS_JSON', '')
 SPREADSHEET_ID = os.getenv('GSHEET_ANALYTICS_ID', '')
 ADMIN_BOT_TOKEN = os.getenv('ADMIN_BOT_TOKEN', '')
@@ -54,40 +97,242 @@ USER_BOT_TOKEN = os.getenv('USER_BOT_TOKEN', '')
 DB_PATH = os.getenv('DB_PATH', 'bot.db')
 MEDIA_DIR = os.getenv('MEDIA_DIR', 'media')
 
+# Maximum number of updates handled at once across different chats
+UPDATE_CONCURRENCY = 16
+
+# Maximum number of mailing messages in flight at once
+MAILING_CONCURRENCY = 25
+
+# How many user ids a mailing reads from the database at a time
+MAILING_USER_PAGE = 500
+
+# How many times a mailing message is attempted when Telegram answers with RetryAfter
+MAILING_SEND_ATTEMPTS = 3
+
+# Upper bound for how long the background workers sleep between checks (seconds)
+POLL_INTERVAL = 60
+
+# How often the support worker checks PRAGMA data_version for writes by the user bot (seconds)
+SUPPORT_POLL_INTERVAL = 5
+
+# How long a claimed support request may stay unforwarded before it is claimed again (seconds)
+SUPPORT_CLAIM_TIMEOUT = 300
+
+# Rows per page in the mailings, support requests and promo codes lists
+PAGE_SIZE = 10
+
+# How long menu listings (categories, products, promotions) stay cached (seconds)
+MENU_CACHE_TTL = 30
+
+# Set when a mailing is scheduled so the mailing worker re-reads the queue
+new_mailing_event = asyncio.Event()
+
 # Ensure media directory exists
 os.makedirs(MEDIA_DIR, exist_ok=True)
 
 # --- Back Button Keyboard ---
 BACK_BUTTON = [[KeyboardButton("🔙 Назад")]]
 
+# Message filters shared by every conversation handler in main()
+BACK_FILTER = filters.Regex(re.compile(r'^🔙 Назад$'))
+TEXT_NOCMD = filters.TEXT & ~filters.COMMAND
+
 def get_back_keyboard():
     """Return a ReplyKeyboardMarkup with a Back button."""
     return ReplyKeyboardMarkup(BACK_BUTTON, resize_keyboard=True, one_time_keyboard=True)
 
+# Inline "back" markups shared by every reply that offers a single way back
+BACK_TO_MAIN = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data='back_to_main')]])
+BACK_TO_CATALOG = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К каталогу", callback_data='catalog')]])
+BACK_TO_CATEGORIES = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К категориям", callback_data='categories')]])
+BACK_TO_PROMO_CODES = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К промокодам", callback_data='list_promo_codes')]])
+BACK_TO_MAILINGS = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К рассылкам", callback_data='view_mailings')]])
+BACK_TO_SUPPORT = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К запросам", callback_data='support_requests')]])
+
+# Reply for handlers whose listing could not be read; cached listings raise instead of caching the failure
+DB_ERROR_TEXT = "❗ Ошибка базы данных. Попробуйте позже."
+
+# --- Menu Keyboards ---
+# Built markups keyed by menu name, reused while the cached listing object is the same
+_keyboard_cache = {}
+
+def cached_keyboard(name: str, items: list, build) -> InlineKeyboardMarkup:
+    """Return build(items), rebuilding only when the listing cache hands out a new list."""
+    cached = _keyboard_cache.get(name)
+    if cached is not None and cached[0] is items:
+        return cached[1]
+    reply_markup = build(items)
+    _keyboard_cache[name] = (items, reply_markup)
+    return reply_markup
+
+def build_catalog_keyboard(prods: list) -> InlineKeyboardMarkup:
+    """One button per product for the catalog menu."""
+    keyboard = [
+        [InlineKeyboardButton(f"#{p['id']} {p['prod_name']} - {int(p['price'])}₽", callback_data=f"product_{p['id']}")]
+        for p in prods
+    ]
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data='back_to_main')])
+    return InlineKeyboardMarkup(keyboard)
+
+def build_categories_keyboard(categories: list) -> InlineKeyboardMarkup:
+    """One button per category for the categories menu."""
+    keyboard = [
+        [InlineKeyboardButton(f"#{c['id']} {c['name']}", callback_data=f"category_{c['id']}")]
+        for c in categories
+    ]
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data='back_to_main')])
+    return InlineKeyboardMarkup(keyboard)
+
+def build_category_choice_keyboard(categories: list) -> InlineKeyboardMarkup:
+    """Category picker for the add-product flow."""
+    keyboard = [[InlineKeyboardButton(cat['name'], callback_data=f"cat_{cat['id']}")] for cat in categories]
+    keyboard.append([InlineKeyboardButton("➕ Новая категория", callback_data="new_category")])
+    return InlineKeyboardMarkup(keyboard)
+
+def build_promo_product_keyboard(products: list) -> InlineKeyboardMarkup:
+    """Product picker for the add-promo-code flow."""
+    keyboard = [
+        [InlineKeyboardButton(f"#{p['id']} {p['prod_name']}", callback_data=f"promo_product_{p['id']}")]
+        for p in products
+    ]
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data='back_to_main')])
+    return InlineKeyboardMarkup(keyboard)
+
+def page_nav_row(kind: str, page: int, rows: list) -> list:
+    """Prev/next buttons for a page fetched with PAGE_SIZE + 1 rows; callbacks are "<kind>_<page>"."""
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀ Пред.", callback_data=f"{kind}_{page - 1}"))
+    if len(rows) > PAGE_SIZE:
+        nav.append(InlineKeyboardButton("След. ▶", callback_data=f"{kind}_{page + 1}"))
+    return nav
+
+def build_promo_codes_keyboard(promo_codes: list, page: int = 0) -> InlineKeyboardMarkup:
+    """A page of active promo codes with a deactivate button each."""
+    keyboard = [
+        [
+            InlineKeyboardButton(f"#{p['id']} {p['code']} ({p['prod_name']}, {p['discount_percentage']}%)", callback_data=f"promo_code_{p['id']}"),
+            InlineKeyboardButton("🗑", callback_data=f"deactivate_promo_{p['id']}")
+        ]
+        for p in promo_codes[:PAGE_SIZE]
+    ]
+    nav = page_nav_row('promo_codes', page, promo_codes)
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data='back_to_main')])
+    return InlineKeyboardMarkup(keyboard)
+
 # --- Database Connection ---
+DB_PRAGMAS = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA busy_timeout=5000;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA cache_size=-64000;
+    PRAGMA mmap_size=268435456;
+    PRAGMA temp_store=MEMORY;
+"""
+
+_conn = None
+_conn_lock = threading.RLock()
+
+def _get_shared_conn():
+    """Open the process-wide SQLite connection on first use."""
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(
+            DB_PATH, check_same_thread=False, cached_statements=256, isolation_level=None
+        )
+        _conn.executescript(DB_PRAGMAS)
+        logger.info(f"Opened SQLite connection to {DB_PATH}")
+    return _conn
+
 @contextmanager
-def get_conn():
-    """Context manager for SQLite connections."""
-    try:
-        conn = sqlite3.connect(DB_PATH, timeout=10)
-        conn.row_factory = sqlite3.Row
-        yield conn
-        conn.commit()
-    except sqlite3.OperationalError as e:
-        logger.error(f"Database error: {e}")
-        raise
-    except Exception:
-        conn.rollback()
-        raise
-    finally:
-        conn.close()
+def get_conn(row_factory=sqlite3.Row, immediate=False):
+    """Context manager for the shared SQLite connection.
+
+    Write-only helpers pass row_factory=None so no result rows get wrapped.
+    Helpers that read before writing pass immediate=True to take the write
+    lock up front (BEGIN IMMEDIATE) instead of failing to upgrade it later.
+    Handlers call the helpers through asyncio.to_thread; _conn_lock keeps
+    worker threads from interleaving statements on the shared connection.
+    """
+    with _conn_lock:
+        conn = _get_shared_conn()
+        conn.row_factory = row_factory
+        if conn.in_transaction:
+            # Nested use joins the outer transaction
+            yield conn
+            return
+        conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        try:
+            yield conn
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            logger.error(f"Database error: {e}")
+            conn.rollback()
+            raise
+        except Exception:
+            conn.rollback()
+            raise
+
+def fetch_scalar(sql: str, params=()):
+    """Run a single-value query and return that value, or None when no row matches."""
+    with get_conn(row_factory=None) as conn:
+        row = conn.execute(sql, params).fetchone()
+    return row[0] if row else None
+
+# --- Hot SQL Statements ---
+# Kept as module constants so the shared connection's statement cache reuses
+# the compiled statements instead of re-preparing them on every call.
+SQL_GET_CATEGORY = "SELECT id, name FROM categories WHERE id = ?"
+SQL_GET_CATEGORY_WITH_COUNT = """
+    SELECT c.id, c.name,
+           (SELECT COUNT(*) FROM all_info WHERE category_id = c.id) AS product_count
+    FROM categories c
+    WHERE c.id = ?
+"""
+SQL_GET_PRODUCT = "SELECT * FROM all_info WHERE id = ?"
+SQL_PROMOTIONS_TEXT = """
+    SELECT GROUP_CONCAT(
+        '#' || id || ': ' || name || ' (' || start_date || '–' || end_date || ')' || char(10)
+            || COALESCE(NULLIF(description, ''), 'Без описания'),
+        char(10)
+    )
+    FROM (SELECT id, name, description, start_date, end_date FROM promotions ORDER BY start_date)
+"""
+SQL_FETCH_PROMO_CODES = """
+    SELECT pc.id, pc.code, pc.product_id, p.prod_name, pc.discount_percentage, pc.start_date, pc.end_date, pc.is_active
+    FROM promo_codes pc
+    JOIN all_info p ON pc.product_id = p.id
+    WHERE pc.is_active = 1
+    ORDER BY pc.created_at
+    LIMIT ? OFFSET ?
+"""
+SQL_CLAIM_DUE_MAILINGS = """
+    UPDATE mailings SET status = 'sending'
+    WHERE status = 'scheduled' AND send_at <= ?
+    RETURNING id, content, send_at
+"""
+SQL_NEXT_MAILING = "SELECT MIN(send_at) AS next_send_at FROM mailings WHERE status = 'scheduled'"
+SQL_CLAIM_SUPPORT_REQUESTS = """
+    UPDATE support_requests SET claimed_at = ?
+    WHERE claimed_at IS NULL OR claimed_at <= ?
+    RETURNING id, user_id, username, content, created_at
+"""
 
 # --- Database Initialization ---
+# Bump when the schema script in init_db changes
+SCHEMA_VERSION = 6
+
 def init_db():
-    """Initialize database schema."""
+    """Initialize database schema unless PRAGMA user_version says it is current."""
     try:
         with get_conn() as conn:
             cursor = conn.cursor()
+            cursor.execute("PRAGMA user_version")
+            if cursor.fetchone()[0] >= SCHEMA_VERSION:
+                logger.info("Database schema is up to date")
+                return
             cursor.executescript("""
                 CREATE TABLE IF NOT EXISTS categories (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -102,6 +347,7 @@ def init_db():
                     size TEXT,
                     material TEXT,
                     photo_path TEXT,
+                    photo_file_id TEXT,
                     FOREIGN KEY (category_id) REFERENCES categories(id)
                 );
                 CREATE TABLE IF NOT EXISTS support_requests (
@@ -110,6 +356,7 @@ def init_db():
                     username TEXT,
                     content TEXT NOT NULL,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    claimed_at INTEGER,
                     FOREIGN KEY (user_id) REFERENCES telegram_profiles(telegram_id)
                 );
                 CREATE TABLE IF NOT EXISTS buy (
@@ -147,10 +394,31 @@ def init_db():
                 CREATE TABLE IF NOT EXISTS mailings (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     content TEXT NOT NULL,
-                    send_at TIMESTAMP NOT NULL,
+                    send_at INTEGER NOT NULL,
                     status TEXT NOT NULL DEFAULT 'scheduled'
                 );
+                CREATE INDEX IF NOT EXISTS idx_buy_product ON buy(product_id);
+                CREATE INDEX IF NOT EXISTS idx_buy_added ON buy(added_at);
+                CREATE INDEX IF NOT EXISTS idx_allinfo_cat ON all_info(category_id);
+                CREATE INDEX IF NOT EXISTS idx_promo_product ON promo_codes(product_id);
+                CREATE INDEX IF NOT EXISTS idx_mailings_status_send ON mailings(status, send_at);
+                CREATE INDEX IF NOT EXISTS idx_buy_user ON buy(user_id);
+                CREATE INDEX IF NOT EXISTS idx_support_user ON support_requests(user_id);
+                CREATE INDEX IF NOT EXISTS idx_mailings_send_at ON mailings(send_at);
             """)
+            # all_info may predate photo_file_id (or have been created by the user bot)
+            cursor.execute("PRAGMA table_info(all_info)")
+            if 'photo_file_id' not in {row['name'] for row in cursor.fetchall()}:
+                cursor.execute("ALTER TABLE all_info ADD COLUMN photo_file_id TEXT")
+            cursor.execute("PRAGMA table_info(support_requests)")
+            if 'claimed_at' not in {row['name'] for row in cursor.fetchall()}:
+                cursor.execute("ALTER TABLE support_requests ADD COLUMN claimed_at INTEGER")
+            # Older mailings stored send_at as local ISO text; convert them to epoch seconds
+            cursor.execute(
+                "UPDATE mailings SET send_at = CAST(strftime('%s', send_at, 'utc') AS INTEGER) "
+                "WHERE typeof(send_at) = 'text'"
+            )
+            cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
             cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='categories'")
             if not cursor.fetchone():
                 logger.error("Failed to create categories table")
@@ -162,22 +430,67 @@ def init_db():
 
 # --- Admin Check Decorator ---
 def admin_only(func):
-    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    @wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args):
         user_id = update.effective_user.id
-        if user_id not in ADMIN_IDS:
-            logger.warning(f"Unauthorized access attempt by user {user_id}")
-            if update.message:
-                await update.message.reply_text('❌ Доступ запрещён.')
+        if user_id in ADMIN_IDS:
+            return await func(update, context, *args)
+        logger.warning(f"Unauthorized access attempt by user {user_id}")
+        msg = get_reply_target(update)
+        if msg is None:
             return
-        return await func(update, context)
-    wrapper.__name__ = func.__name__
+        await msg.reply_text('❌ Доступ запрещён.')
     return wrapper
 
 # --- Message Reply Helper ---
 def get_reply_target(update: Update):
     return update.callback_query.message if update.callback_query else update.message
 
+async def replace_callback_message(query, text: str, reply_markup=None, parse_mode=None):
+    """Show text in place of the callback's message, editing it in one API call when possible."""
+    if query.message.text is None:
+        # Photo messages cannot be edited into text ones; send anew and drop the old message
+        await query.message.reply_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+        await query.delete_message()
+    else:
+        try:
+            await query.edit_message_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+        except BadRequest as e:
+            if "message is not modified" in str(e):
+                return
+            if "can't be edited" not in str(e):
+                raise
+            await query.message.reply_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+            await query.delete_message()
+
+# --- Callback Data Parsing ---
+# "<kind>_<id>" callbacks, e.g. "delete_category_5" -> ("delete_category", 5)
+CALLBACK_ID_RE = re.compile(r'^(?P<kind>[a-z_]+)_(?P<id>\d+)$')
+
+def parse_callback_id(data: str) -> int:
+    """Return the numeric id at the end of "<kind>_<id>" callback data."""
+    return int(CALLBACK_ID_RE.match(data).group('id'))
+
+# --- Promo Code Validation ---
+# Bytes a promo code may consist of (codes are upper-cased before the check)
+PROMO_CODE_ALLOWED = b'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+
+# --- Date Parsing ---
+def parse_iso_date(txt: str):
+    """Parse a strict YYYY-MM-DD date; return None if txt is malformed."""
+    if len(txt) != 10 or txt[4] != '-' or txt[7] != '-':
+        return None
+    try:
+        return date.fromisoformat(txt)
+    except ValueError:
+        return None
+
+def format_send_at(send_at: int) -> str:
+    """Render a mailing's epoch send_at in local time."""
+    return datetime.fromtimestamp(send_at).strftime('%Y-%m-%d %H:%M')
+
 # --- Database Functions ---
+@ttl_cache(maxsize=1, ttl=MENU_CACHE_TTL)
 def get_categories():
     """Retrieve all categories."""
     try:
@@ -185,20 +498,22 @@ def get_categories():
             cursor = conn.cursor()
             cursor.execute("SELECT id, name FROM categories ORDER BY name")
             categories = [dict(row) for row in cursor.fetchall()]
-            logger.info(f"Fetched {len(categories)} categories")
+            logger.debug("Fetched %d categories", len(categories))
             return categories
     except Exception as e:
         logger.error(f"Error fetching categories: {e}")
-        return []
+        raise
 
 def create_category(name: str) -> int:
     """Create a new category."""
     try:
         logger.info(f"Attempting to create category: '{name}'")
-        with get_conn() as conn:
+        with get_conn(row_factory=None) as conn:
             cursor = conn.cursor()
             cursor.execute("INSERT INTO categories (name) VALUES (?)", (name,))
             category_id = cursor.lastrowid
+            get_category_by_id.cache_clear()
+            get_categories.cache_clear()
             logger.info(f"Category '{name}' created with ID: {category_id}")
             return category_id
     except sqlite3.IntegrityError:
@@ -208,51 +523,88 @@ def create_category(name: str) -> int:
         logger.error(f"Error creating category '{name}': {e}")
         raise
 
-def delete_category(category_id: int):
-    """Delete a category and all associated products and media."""
+def read_media_file(photo_path: str):
+    """Read a stored media file, or return None if it is missing; meant to run off the event loop."""
     try:
-        with get_conn() as conn:
+        with open(os.path.join(MEDIA_DIR, photo_path), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def remove_media_dirs(product_dirs: list):
+    """Remove product media directories; meant to run off the event loop."""
+    for product_dir in product_dirs:
+        shutil.rmtree(product_dir, ignore_errors=True)
+        logger.info(f"Deleted media directory: {product_dir}")
+
+def delete_category(category_id: int) -> list:
+    """Delete a category and all associated products; return their media directories."""
+    try:
+        with get_conn(immediate=True) as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT id, photo_path FROM all_info WHERE category_id = ?", (category_id,))
             products = cursor.fetchall()
-            for product in products:
-                product_id = product['id']
-                photo_path = product['photo_path']
-                cursor.execute("DELETE FROM all_info WHERE id = ?", (product_id,))
-                cursor.execute("DELETE FROM buy WHERE product_id = ?", (product_id,))
-                cursor.execute("DELETE FROM promo_codes WHERE product_id = ?", (product_id,))
-                if photo_path:
-                    product_dir = os.path.join(MEDIA_DIR, str(product_id))
-                    if os.path.exists(product_dir):
-                        shutil.rmtree(product_dir)
-                        logger.info(f"Deleted media directory for product #{product_id}: {product_dir}")
-                logger.info(f"Product #{product_id} deleted as part of category #{category_id} deletion")
+            cursor.execute(
+                "DELETE FROM buy WHERE product_id IN (SELECT id FROM all_info WHERE category_id = ?)",
+                (category_id,)
+            )
+            cursor.execute(
+                "DELETE FROM promo_codes WHERE product_id IN (SELECT id FROM all_info WHERE category_id = ?)",
+                (category_id,)
+            )
+            cursor.execute("DELETE FROM all_info WHERE category_id = ?", (category_id,))
+            logger.info(f"{len(products)} products deleted as part of category #{category_id} deletion")
             cursor.execute("DELETE FROM categories WHERE id = ?", (category_id,))
             if cursor.rowcount == 0:
                 logger.warning(f"No category found with ID {category_id}")
                 raise ValueError(f"Категория #{category_id} не найдена")
+            get_category_by_id.cache_clear()
+            get_categories.cache_clear()
+            clear_product_caches()
             logger.info(f"Category #{category_id} deleted")
+            return [os.path.join(MEDIA_DIR, str(p['id'])) for p in products if p['photo_path']]
     except Exception as e:
         logger.error(f"Error deleting category #{category_id}: {e}")
         raise
 
+@lru_cache(maxsize=256)
 def get_category_by_id(category_id: int):
-    """Retrieve a category by ID."""
+    """Retrieve a category by ID; cached until categories change, errors are raised rather than cached."""
     try:
         with get_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT id, name FROM categories WHERE id = ?", (category_id,))
+            cursor.execute(SQL_GET_CATEGORY, (category_id,))
             category = cursor.fetchone()
             return dict(category) if category else None
     except Exception as e:
         logger.error(f"Error fetching category #{category_id}: {e}")
-        return None
+        raise
+
+def get_category_id_by_name(name: str):
+    """Return the ID of the category with this exact name, or None."""
+    try:
+        return fetch_scalar("SELECT id FROM categories WHERE name = ?", (name,))
+    except Exception as e:
+        logger.error(f"Error fetching category '{name}': {e}")
+        raise
+
+def get_category_with_count(category_id: int):
+    """Retrieve a category together with its product count in one query."""
+    try:
+        with get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(SQL_GET_CATEGORY_WITH_COUNT, (category_id,))
+            category = cursor.fetchone()
+            return dict(category) if category else None
+    except Exception as e:
+        logger.error(f"Error fetching category #{category_id}: {e}")
+        raise
 
 def create_product(category_id: int, name: str, price: float, desc: str, photo_path: str, size: str, material: str) -> int:
     """Create a new product."""
     try:
         logger.info(f"Creating product: '{name}' in category {category_id}")
-        with get_conn() as conn:
+        with get_conn(row_factory=None) as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
@@ -262,16 +614,69 @@ def create_product(category_id: int, name: str, price: float, desc: str, photo_p
                 (category_id, name, desc, price, photo_path, size, material)
             )
             product_id = cursor.lastrowid
+            clear_product_caches()
             logger.info(f"Product '{name}' created with ID: {product_id}")
             return product_id
     except Exception as e:
         logger.error(f"Error creating product '{name}': {e}")
         raise
 
-def delete_product(product_id: int):
-    """Delete a product and its associated media and promo codes."""
+def create_product_with_photo(category_id: int, name: str, price: float, desc: str, size: str, material: str,
+                              photo: bytes, file_extension: str, photo_file_id: str = None) -> tuple:
+    """Create a product and store its photo; return (product_id, photo_path).
+
+    The photo is written to a temporary file before the write transaction starts and
+    moved into media/<product_id>/ only after the commit, so no disk I/O happens while
+    the write lock is held and a rolled-back product leaves no files behind.
+    photo_file_id is the admin bot's Telegram file_id for the photo, reused when showing the product.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=MEDIA_DIR, suffix=file_extension)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(photo)
+        logger.info(f"Creating product: '{name}' in category {category_id}")
+        with get_conn(row_factory=None, immediate=True) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                INSERT INTO all_info (category_id, prod_name, prod_desc, price, size, material)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (category_id, name, desc, price, size, material)
+            )
+            product_id = cursor.lastrowid
+            photo_path = os.path.join(str(product_id), f"product_{product_id}{file_extension}")
+            cursor.execute(
+                "UPDATE all_info SET photo_path = ?, photo_file_id = ? WHERE id = ?",
+                (photo_path, photo_file_id, product_id)
+            )
+        os.makedirs(os.path.join(MEDIA_DIR, str(product_id)), exist_ok=True)
+        os.replace(tmp_path, os.path.join(MEDIA_DIR, photo_path))
+        clear_product_caches()
+        logger.info(f"Product '{name}' created with ID: {product_id}")
+        return product_id, photo_path
+    except Exception as e:
+        logger.error(f"Error creating product '{name}': {e}")
+        raise
+    finally:
+        # Only still present if the product was not created or the move failed
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def set_product_photo_file_id(product_id: int, photo_file_id: str):
+    """Remember the Telegram file_id of an uploaded product photo."""
     try:
-        with get_conn() as conn:
+        with get_conn(row_factory=None) as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE all_info SET photo_file_id = ? WHERE id = ?", (photo_file_id, product_id))
+            get_product_by_id.cache_clear()
+    except Exception as e:
+        logger.error(f"Error saving photo file_id for product #{product_id}: {e}")
+
+def delete_product(product_id: int) -> list:
+    """Delete a product and its promo codes; return its media directories."""
+    try:
+        with get_conn(immediate=True) as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT photo_path FROM all_info WHERE id = ?", (product_id,))
             product = cursor.fetchone()
@@ -280,42 +685,71 @@ def delete_product(product_id: int):
                 raise ValueError(f"Товар #{product_id} не найден")
             photo_path = product['photo_path']
             cursor.execute("DELETE FROM all_info WHERE id = ?", (product_id,))
+            clear_product_caches()
             cursor.execute("DELETE FROM buy WHERE product_id = ?", (product_id,))
             cursor.execute("DELETE FROM promo_codes WHERE product_id = ?", (product_id,))
-            if photo_path:
-                product_dir = os.path.join(MEDIA_DIR, str(product_id))
-                if os.path.exists(product_dir):
-                    shutil.rmtree(product_dir)
-                    logger.info(f"Deleted media directory for product #{product_id}: {product_dir}")
             logger.info(f"Product #{product_id} deleted")
+            return [os.path.join(MEDIA_DIR, str(product_id))] if photo_path else []
     except Exception as e:
         logger.error(f"Error deleting product #{product_id}: {e}")
         raise
 
-def fetch_promotions():
-    """Retrieve all promotions."""
+def create_products_bulk(rows: list) -> int:
+    """Create several products in one transaction.
+
+    Each row is (category_id, name, desc, price, photo_path, size, material).
+    """
     try:
-        with get_conn() as conn:
+        with get_conn(row_factory=None) as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                """
-                SELECT id, name, description, image_url, start_date, end_date
-                FROM promotions
-                ORDER BY start_date
+            cursor.executemany(
                 """
+                INSERT INTO all_info (category_id, prod_name, prod_desc, price, photo_path, size, material)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                rows
             )
-            promotions = [dict(row) for row in cursor.fetchall()]
-            logger.info(f"Fetched {len(promotions)} promotions")
-            return promotions
+            clear_product_caches()
+            logger.info(f"Created {cursor.rowcount} products in bulk")
+            return cursor.rowcount
     except Exception as e:
-        logger.error(f"Error fetching promotions: {e}")
+        logger.error(f"Error creating products in bulk: {e}")
+        raise
+
+def delete_products_bulk(product_ids: list) -> list:
+    """Delete several products with their carts and promo codes; return their media directories."""
+    if not product_ids:
         return []
+    placeholders = ','.join('?' * len(product_ids))
+    try:
+        with get_conn(immediate=True) as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT id, photo_path FROM all_info WHERE id IN ({placeholders})", product_ids)
+            media_dirs = [os.path.join(MEDIA_DIR, str(row[0])) for row in cursor.fetchall() if row[1]]
+            cursor.execute(f"DELETE FROM buy WHERE product_id IN ({placeholders})", product_ids)
+            cursor.execute(f"DELETE FROM promo_codes WHERE product_id IN ({placeholders})", product_ids)
+            cursor.execute(f"DELETE FROM all_info WHERE id IN ({placeholders})", product_ids)
+            clear_product_caches()
+            logger.info(f"Deleted {cursor.rowcount} products in bulk")
+            return media_dirs
+    except Exception as e:
+        logger.error(f"Error deleting products in bulk: {e}")
+        raise
+
+@ttl_cache(maxsize=1, ttl=MENU_CACHE_TTL)
+def fetch_promotions_formatted() -> str:
+    """Return all promotions as one ready-to-send text block, or '' if there are none."""
+    try:
+        return fetch_scalar(SQL_PROMOTIONS_TEXT) or ''
+    except Exception as e:
+        logger.error(f"Error fetching promotions: {e}")
+        raise
 
 def create_promotion(name: str, description: str, image_url: str, start: str, end: str) -> int:
     """Create a new promotion."""
     try:
         logger.info(f"Creating promotion: '{name}'")
-        with get_conn() as conn:
+        with get_conn(row_factory=None) as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
@@ -325,6 +759,7 @@ def create_promotion(name: str, description: str, image_url: str, start: str, en
                 (name, description, image_url, start, end)
             )
             promotion_id = cursor.lastrowid
+            fetch_promotions_formatted.cache_clear()
             logger.info(f"Promotion '{name}' created with ID: {promotion_id}")
             return promotion_id
     except Exception as e:
@@ -334,12 +769,13 @@ def create_promotion(name: str, description: str, image_url: str, start: str, en
 def delete_promotion(promo_id: int):
     """Delete a promotion."""
     try:
-        with get_conn() as conn:
+        with get_conn(row_factory=None) as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM promotions WHERE id = ?", (promo_id,))
             if cursor.rowcount == 0:
                 logger.warning(f"No promotion found with ID {promo_id}")
                 raise ValueError(f"Акция #{promo_id} не найдена")
+            fetch_promotions_formatted.cache_clear()
             logger.info(f"Promotion #{promo_id} deleted")
     except Exception as e:
         logger.error(f"Error deleting promotion #{promo_id}: {e}")
@@ -349,7 +785,7 @@ def create_promo_code(code: str, product_id: int, discount_percentage: int, star
     """Создать новый промокод."""
     try:
         logger.info(f"Creating promo code: '{code}' for product {product_id}")
-        with get_conn() as conn:
+        with get_conn(row_factory=None) as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
@@ -359,6 +795,7 @@ def create_promo_code(code: str, product_id: int, discount_percentage: int, star
                 (code, product_id, discount_percentage, start_date, end_date)
             )
             promo_id = cursor.lastrowid
+            fetch_promo_codes.cache_clear()
             logger.info(f"Promo code '{code}' created with ID: {promo_id}")
             return promo_id
     except sqlite3.IntegrityError:
@@ -368,8 +805,22 @@ def create_promo_code(code: str, product_id: int, discount_percentage: int, star
         logger.error(f"Error creating promo code '{code}': {e}")
         raise
 
-def fetch_promo_codes():
-    """Получить все промокоды."""
+@ttl_cache(maxsize=16, ttl=MENU_CACHE_TTL)
+def fetch_promo_codes(page: int = 0):
+    """Получить страницу активных промокодов (PAGE_SIZE + 1 строк, чтобы знать о следующей)."""
+    try:
+        with get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(SQL_FETCH_PROMO_CODES, (PAGE_SIZE + 1, page * PAGE_SIZE))
+            promo_codes = [dict(row) for row in cursor.fetchall()]
+            logger.debug("Fetched %d promo codes", len(promo_codes))
+            return promo_codes
+    except Exception as e:
+        logger.error(f"Error fetching promo codes: {e}")
+        raise
+
+def get_promo_code(promo_id: int):
+    """Получить промокод вместе с названием товара."""
     try:
         with get_conn() as conn:
             cursor = conn.cursor()
@@ -378,30 +829,32 @@ def fetch_promo_codes():
                 SELECT pc.id, pc.code, pc.product_id, p.prod_name, pc.discount_percentage, pc.start_date, pc.end_date, pc.is_active
                 FROM promo_codes pc
                 JOIN all_info p ON pc.product_id = p.id
-                ORDER BY pc.created_at
-                """
+                WHERE pc.id = ?
+                """,
+                (promo_id,)
             )
-            promo_codes = [dict(row) for row in cursor.fetchall()]
-            logger.info(f"Fetched {len(promo_codes)} promo codes")
-            return promo_codes
+            promo = cursor.fetchone()
+            return dict(promo) if promo else None
     except Exception as e:
-        logger.error(f"Error fetching promo codes: {e}")
-        return []
+        logger.error(f"Error fetching promo code #{promo_id}: {e}")
+        raise
 
 def deactivate_promo_code(promo_id: int):
     """Деактивировать промокод."""
     try:
-        with get_conn() as conn:
+        with get_conn(row_factory=None) as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE promo_codes SET is_active = 0 WHERE id = ?", (promo_id,))
             if cursor.rowcount == 0:
                 logger.warning(f"No promo code found with ID {promo_id}")
                 raise ValueError(f"Промокод #{promo_id} не найден")
+            fetch_promo_codes.cache_clear()
             logger.info(f"Promo code #{promo_id} deactivated")
     except Exception as e:
         logger.error(f"Error deactivating promo code #{promo_id}: {e}")
         raise
 
+@ttl_cache(maxsize=1, ttl=MENU_CACHE_TTL)
 def fetch_products():
     """Retrieve all products."""
     try:
@@ -409,60 +862,112 @@ def fetch_products():
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM all_info ORDER BY id")
             products = [dict(row) for row in cursor.fetchall()]
-            logger.info(f"Fetched {len(products)} products")
+            logger.debug("Fetched %d products", len(products))
             return products
     except Exception as e:
         logger.error(f"Error fetching products: {e}")
-        return []
+        raise
 
+def clear_product_caches():
+    """Drop cached product lookups and listings after products change."""
+    get_product_by_id.cache_clear()
+    fetch_products.cache_clear()
+    fetch_promo_codes.cache_clear()
+
+@lru_cache(maxsize=256)
 def get_product_by_id(product_id: int):
-    """Retrieve a product by ID."""
+    """Retrieve a product by ID; cached until products change, errors are raised rather than cached."""
     try:
         with get_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM all_info WHERE id = ?", (product_id,))
+            cursor.execute(SQL_GET_PRODUCT, (product_id,))
             product = cursor.fetchone()
             return dict(product) if product else None
     except Exception as e:
         logger.error(f"Error fetching product #{product_id}: {e}")
-        return None
+        raise
 
-def fetch_users():
-    """Retrieve all telegram profiles."""
+@ttl_cache(maxsize=1, ttl=MENU_CACHE_TTL)
+def fetch_user_count() -> int:
+    """Count telegram profiles; new profiles come from the user bot, so the TTL bounds staleness."""
     try:
-        with get_conn() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT telegram_id FROM telegram_profiles")
-            users = [row['telegram_id'] for row in cursor.fetchall()]
-            logger.info(f"Fetched {len(users)} users")
-            return users
+        return fetch_scalar("SELECT COUNT(*) FROM telegram_profiles")
     except Exception as e:
-        logger.error(f"Error fetching users: {e}")
-        return []
+        logger.error(f"Error counting users: {e}")
+        raise
 
-def fetch_support_requests():
-    """Retrieve all pending support requests."""
+def fetch_user_ids_after(last_id: int, limit: int = MAILING_USER_PAGE) -> list:
+    """Return up to limit telegram IDs greater than last_id, in ascending order."""
+    with get_conn(row_factory=None) as conn:
+        rows = conn.execute(
+            "SELECT telegram_id FROM telegram_profiles WHERE telegram_id > ? ORDER BY telegram_id LIMIT ?",
+            (last_id, limit)
+        ).fetchall()
+    return [row[0] for row in rows]
+
+def set_mailing_status(mailing_id: int, status: str):
+    """Record the outcome of a mailing."""
+    with get_conn(row_factory=None) as conn:
+        conn.execute("UPDATE mailings SET status = ? WHERE id = ?", (status, mailing_id))
+
+def fetch_support_requests(page: int = 0):
+    """Retrieve a page of (id, username, created_at) tuples, PAGE_SIZE + 1 rows to detect a next page."""
     try:
-        with get_conn() as conn:
+        with get_conn(row_factory=None) as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
-                SELECT id, user_id, username, content, created_at
+                SELECT id, COALESCE(username, 'N/A'), created_at
                 FROM support_requests
                 ORDER BY created_at
-                """
+                LIMIT ? OFFSET ?
+                """,
+                (PAGE_SIZE + 1, page * PAGE_SIZE)
             )
-            requests = [dict(row) for row in cursor.fetchall()]
-            logger.info(f"Fetched {len(requests)} support requests")
+            requests = cursor.fetchall()
+            logger.debug("Fetched %d support requests", len(requests))
             return requests
     except Exception as e:
         logger.error(f"Error fetching support requests: {e}")
         return []
 
+def get_support_request(request_id: int):
+    """Retrieve a support request by ID."""
+    try:
+        with get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT id, user_id, username, content, created_at
+                FROM support_requests
+                WHERE id = ?
+                """,
+                (request_id,)
+            )
+            request = cursor.fetchone()
+            return dict(request) if request else None
+    except Exception as e:
+        logger.error(f"Error fetching support request #{request_id}: {e}")
+        raise
+
+def delete_user_data(user_id: int):
+    """Remove a blocked user's profile, purchases and support requests in one transaction."""
+    try:
+        with get_conn(row_factory=None, immediate=True) as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM telegram_profiles WHERE telegram_id = ?", (user_id,))
+            cursor.execute("DELETE FROM buy WHERE user_id = ?", (user_id,))
+            cursor.execute("DELETE FROM support_requests WHERE user_id = ?", (user_id,))
+            logger.info(f"Data of user {user_id} deleted")
+        fetch_user_count.cache_clear()
+    except Exception as e:
+        logger.error(f"Error deleting data of user {user_id}: {e}")
+        raise
+
 def delete_support_request(request_id: int):
     """Delete a support request."""
     try:
-        with get_conn() as conn:
+        with get_conn(row_factory=None) as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM support_requests WHERE id = ?", (request_id,))
             if cursor.rowcount == 0:
@@ -473,10 +978,93 @@ def delete_support_request(request_id: int):
         logger.error(f"Error deleting support request #{request_id}: {e}")
         raise
 
+def create_mailing(content: str, send_at: int) -> int:
+    """Schedule a mailing; send_at is Unix epoch seconds."""
+    try:
+        with get_conn(row_factory=None) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                INSERT INTO mailings (content, send_at, status)
+                VALUES (?, ?, 'scheduled')
+                """,
+                (content, send_at)
+            )
+            return cursor.lastrowid
+    except Exception as e:
+        logger.error(f"Error creating mailing: {e}")
+        raise
+
+def fetch_mailings(page: int = 0):
+    """Retrieve a page of (id, content preview, send_at) tuples, PAGE_SIZE + 1 rows to detect a next page."""
+    try:
+        with get_conn(row_factory=None) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT id, substr(content, 1, 20), send_at
+                FROM mailings
+                ORDER BY send_at
+                LIMIT ? OFFSET ?
+                """,
+                (PAGE_SIZE + 1, page * PAGE_SIZE)
+            )
+            return cursor.fetchall()
+    except Exception as e:
+        logger.error(f"Error fetching mailings: {e}")
+        raise
+
+def get_mailing(mailing_id: int):
+    """Retrieve a mailing by ID."""
+    try:
+        with get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT id, content, send_at, status
+                FROM mailings
+                WHERE id = ?
+                """,
+                (mailing_id,)
+            )
+            mailing = cursor.fetchone()
+            return dict(mailing) if mailing else None
+    except Exception as e:
+        logger.error(f"Error fetching mailing #{mailing_id}: {e}")
+        raise
+
+def claim_support_requests():
+    """Claim unforwarded support requests (and ones whose claim expired), oldest first."""
+    now = int(time.time())
+    with get_conn() as conn:
+        rows = conn.execute(SQL_CLAIM_SUPPORT_REQUESTS, (now, now - SUPPORT_CLAIM_TIMEOUT)).fetchall()
+    return sorted(rows, key=lambda r: r['id'])
+
+def finish_support_request(request_id: int, forwarded: bool):
+    """Remove a forwarded support request, or release its claim so it is forwarded again."""
+    with get_conn(row_factory=None) as conn:
+        if forwarded:
+            conn.execute("DELETE FROM support_requests WHERE id = ?", (request_id,))
+        else:
+            conn.execute("UPDATE support_requests SET claimed_at = NULL WHERE id = ?", (request_id,))
+
+def fail_interrupted_mailings() -> int:
+    """Mark mailings left 'sending' by a previous run as failed; return how many there were.
+
+    Some recipients may already have the message, so they are not resent automatically.
+    """
+    with get_conn(row_factory=None) as conn:
+        return conn.execute("UPDATE mailings SET status = 'failed' WHERE status = 'sending'").rowcount
+
+def claim_due_mailings():
+    """Mark due mailings as sending and return them."""
+    with get_conn() as conn:
+        return conn.execute(SQL_CLAIM_DUE_MAILINGS, (int(time.time()),)).fetchall()
+
 def delete_mailing(mailing_id: int):
     """Delete a mailing."""
     try:
-        with get_conn() as conn:
+        with get_conn(row_factory=None) as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM mailings WHERE id = ?", (mailing_id,))
             if cursor.rowcount == 0:
@@ -488,203 +1076,293 @@ def delete_mailing(mailing_id: int):
         raise
 
 # --- Analytics Functions ---
-def fetch_sales_by_date(start_date: str, end_date: str):
-    """Fetch sales data by date."""
+def load_recent_buys(start_date: str, end_date: str):
+    """Copy purchases in the date range into temp.recent_buys for the analytics queries."""
+    # Half-open range on the raw column so idx_buy_added can be used
+    end_exclusive = (datetime.fromisoformat(end_date) + timedelta(days=1)).date().isoformat()
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS recent_buys (user_id INTEGER, product_id INTEGER, added_at TIMESTAMP)"
+        )
+        cursor.execute("DELETE FROM temp.recent_buys")
+        cursor.execute(
+            """
+            INSERT INTO temp.recent_buys (user_id, product_id, added_at)
+            SELECT user_id, product_id, added_at
+            FROM buy
+            WHERE added_at >= ? AND added_at < ?
+            """,
+            (start_date, end_exclusive)
+        )
+
+def fetch_sales_by_date():
+    """Fetch sales data by date from temp.recent_buys."""
     try:
         with get_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
                 SELECT date(added_at) as order_date, COUNT(*) as total_sales
-                FROM buy
-                WHERE date(added_at) BETWEEN ? AND ?
+                FROM temp.recent_buys
                 GROUP BY date(added_at)
                 ORDER BY order_date
-                """,
-                (start_date, end_date)
+                """
             )
-            return [dict(row) for row in cursor.fetchall()]
+            return cursor.fetchall()
     except Exception as e:
         logger.error(f"Error fetching sales data: {e}")
         return []
 
-def fetch_top_products(start_date: str, end_date: str, limit: int = 10):
-    """Fetch top products by sales."""
+def fetch_top_products(limit: int = 10):
+    """Fetch top products by sales from temp.recent_buys."""
     try:
         with get_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
                 SELECT b.product_id, p.prod_name AS product_name, COUNT(*) AS total_sold
-                FROM buy b
+                FROM temp.recent_buys b
                 JOIN all_info p ON b.product_id = p.id
-                WHERE date(b.added_at) BETWEEN ? AND ?
                 GROUP BY b.product_id, p.prod_name
                 ORDER BY total_sold DESC
                 LIMIT ?
                 """,
-                (start_date, end_date, limit)
+                (limit,)
             )
-            return [dict(row) for row in cursor.fetchall()]
+            return cursor.fetchall()
     except Exception as e:
         logger.error(f"Error fetching top products: {e}")
         return []
 
-def fetch_user_activity(start_date: str, end_date: str, limit: int = 10):
-    """Fetch user activity data."""
+def fetch_user_activity(limit: int = 10):
+    """Fetch user activity data from temp.recent_buys."""
     try:
         with get_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
                 SELECT b.user_id, COUNT(*) AS orders_count
-                FROM buy b
-                WHERE date(b.added_at) BETWEEN ? AND ?
+                FROM temp.recent_buys b
                 GROUP BY b.user_id
                 ORDER BY orders_count DESC
                 LIMIT ?
                 """,
-                (start_date, end_date, limit)
+                (limit,)
             )
-            return [dict(row) for row in cursor.fetchall()]
+            return cursor.fetchall()
     except Exception as e:
         logger.error(f"Error fetching user activity: {e}")
         return []
 
 def fetch_metrics():
-    """Fetch analytics metrics."""
-    start_date = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
-    end_date = datetime.now().strftime('%Y-%m-%d')
-    sales = fetch_sales_by_date(start_date, end_date)
-    top_products = fetch_top_products(start_date, end_date, limit=5)
-    users = fetch_user_activity(start_date, end_date, limit=10)
-    return {'sales': sales, 'top_products': top_products, 'users': users}
+    """Fetch analytics metrics for the last 30 days."""
+    now = datetime.now()
+    start_date = (now - timedelta(days=30)).date().isoformat()
+    end_date = now.date().isoformat()
+    try:
+        # The helpers join this transaction, so the connection lock is held from the load
+        # through the last report and a concurrent run cannot refill temp.recent_buys in between
+        with get_conn():
+            load_recent_buys(start_date, end_date)
+            return {
+                'sales': fetch_sales_by_date(),
+                'top_products': fetch_top_products(limit=5),
+                'users': fetch_user_activity(limit=10),
+            }
+    except Exception as e:
+        logger.error(f"Error loading recent purchases: {e}")
+        return {'sales': [], 'top_products': [], 'users': []}
+
+# The cached client's HTTP transport is not thread-safe
+_sheets_lock = threading.Lock()
+
+@lru_cache(maxsize=1)
+def get_sheets_service():
+    """Build the Google Sheets client once and reuse it."""
+    creds = Credentials.from_service_account_file(CREDENTIALS_PATH, scopes=['https://www.googleapis.com/auth/spreadsheets'])
+    return build('sheets', 'v4', credentials=creds, cache_discovery=False)
 
 def export_to_sheets(metrics: dict):
-    """Export metrics to Google Sheets."""
-    try:
-        creds = Credentials.from_service_account_file(CREDENTIALS_PATH, scopes=['https://www.googleapis.com/auth/spreadsheets'])
-        service = build('sheets', 'v4', credentials=creds)
-        sheet = service.spreadsheets()
-        sales_values = [[r['order_date'], r['total_sales']] for r in metrics['sales']]
-        sheet.values().update(
-            spreadsheetId=SPREADSHEET_ID,
-            range='Sales!A2:B',
-            valueInputOption='RAW',
-            body={'values': sales_values},
-        ).execute()
-        product_values = [[r['product_name'], r['total_sold']] for r in metrics['top_products']]
-        sheet.values().update(
-            spreadsheetId=SPREADSHEET_ID,
-            range='TopProducts!A2:B',
-            valueInputOption='RAW',
-            body={'values': product_values},
-        ).execute()
+    """Export metrics to Google Sheets in a single batchUpdate; meant to run off the event loop."""
+    try:
+        sales_values = [[r[0], int(r[1])] for r in metrics['sales']]
+        product_values = [[r[1], int(r[2])] for r in metrics['top_products']]
+        with _sheets_lock:
+            get_sheets_service().spreadsheets().values().batchUpdate(
+                spreadsheetId=SPREADSHEET_ID,
+                body={
+                    'valueInputOption': 'RAW',
+                    'data': [
+                        {'range': 'Sales!A2:B', 'values': sales_values},
+                        {'range': 'TopProducts!A2:B', 'values': product_values},
+                    ],
+                },
+            ).execute()
         logger.info("Metrics exported to Google Sheets")
     except Exception as e:
         logger.error(f"Error exporting to Google Sheets: {e}")
         raise
 
 # --- Mailing Functions ---
+@lru_cache(maxsize=1)
+def get_user_bot() -> Bot:
+    """Return the shared user-bot client so mailings reuse its HTTP connections."""
+    return Bot(USER_BOT_TOKEN)
+
 async def send_mailing_directly(mailing_id: int, mail_content: str):
     """Send mailing directly to users."""
     logger.info(f"Starting mailing #{mailing_id}")
     try:
-        users = fetch_users()
-        if not users:
-            logger.warning(f"No users found for mailing #{mailing_id}")
-            with get_conn() as conn:
-                cursor = conn.cursor()
-                cursor.execute("UPDATE mailings SET status = 'failed' WHERE id = ?", (mailing_id,))
-            return
-        bot = Bot(USER_BOT_TOKEN)
+        bot = get_user_bot()
         bot_info = await bot.get_me()
         logger.info(f"User bot authenticated: {bot_info.username}")
-        success_count = 0
+        # Only ask Telegram to parse HTML when the text can contain tags
+        parse_mode = 'HTML' if '<' in mail_content and '>' in mail_content else None
+        # Cleared while one send waits out a RetryAfter so every sender pauses with it
+        not_throttled = asyncio.Event()
+        not_throttled.set()
+
+        async def deliver(uid):
+            for attempt in range(MAILING_SEND_ATTEMPTS):
+                await not_throttled.wait()
+                try:
+                    return await bot.send_message(chat_id=uid, text=mail_content, parse_mode=parse_mode)
+                except RetryAfter as e:
+                    if attempt == MAILING_SEND_ATTEMPTS - 1:
+                        raise
+                    if not_throttled.is_set():
+                        logger.warning(f"Mailing #{mailing_id} hit the flood limit, pausing for {e.retry_after}s")
+                        not_throttled.clear()
+                        await asyncio.sleep(e.retry_after)
+                        not_throttled.set()
+
+        # User ids are paged into a bounded queue and sent by a fixed pool of workers
+        user_ids = asyncio.Queue(maxsize=MAILING_CONCURRENCY * 2)
         failed_users = []
-        for uid in users:
+        sent = 0
+
+        async def send_one(uid):
             try:
-                await bot.send_message(chat_id=uid, text=mail_content, parse_mode='HTML')
-                success_count += 1
-                logger.info(f"Mailing #{mailing_id} sent to user {uid}")
-                await asyncio.sleep(0.1)  # Avoid Telegram rate limits
+                await deliver(uid)
+                logger.debug("Mailing #%s sent to user %s", mailing_id, uid)
+                return True
             except TelegramError as e:
-                logger.error(f"Telegram error sending mailing #{mailing_id} to user {uid}: {e}")
+                logger.error("Telegram error sending mailing #%s to user %s: %s", mailing_id, uid, e)
                 failed_users.append({'user_id': uid, 'error': str(e)})
             except Exception as e:
-                logger.error(f"Unexpected error sending mailing #{mailing_id} to user {uid}: {e}")
+                logger.error("Unexpected error sending mailing #%s to user %s: %s", mailing_id, uid, e)
                 failed_users.append({'user_id': uid, 'error': str(e)})
-        status = 'completed' if success_count > 0 else 'failed'
-        with get_conn() as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE mailings SET status = ? WHERE id = ?", (status, mailing_id))
-        logger.info(f"Mailing #{mailing_id} {status}, sent to {success_count}/{len(users)} users")
+            return False
+
+        async def worker():
+            nonlocal sent
+            while (uid := await user_ids.get()) is not None:
+                if await send_one(uid):
+                    sent += 1
+                await asyncio.sleep(1)  # Hold the slot to stay under Telegram's ~30 msg/s limit
+
+        workers = [asyncio.create_task(worker()) for _ in range(MAILING_CONCURRENCY)]
+        total = 0
+        try:
+            last_id = -1
+            while page := await asyncio.to_thread(fetch_user_ids_after, last_id):
+                for uid in page:
+                    await user_ids.put(uid)
+                total += len(page)
+                last_id = page[-1]
+            for _ in workers:
+                await user_ids.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+
+        if not total:
+            logger.warning(f"No users found for mailing #{mailing_id}")
+            await asyncio.to_thread(set_mailing_status, mailing_id, 'failed')
+            return
+        status = 'completed' if sent > 0 else 'failed'
+        await asyncio.to_thread(set_mailing_status, mailing_id, status)
+        logger.info(f"Mailing #{mailing_id} {status}, sent to {sent}/{total} users")
         if failed_users:
             logger.warning(f"Failed to send to users: {failed_users}")
     except Exception as e:
         logger.error(f"Error executing mailing #{mailing_id}: {e}", exc_info=True)
-        with get_conn() as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE mailings SET status = 'failed' WHERE id = ?", (mailing_id,))
+        await asyncio.to_thread(set_mailing_status, mailing_id, 'failed')
 
 async def check_support_requests(context: ContextTypes.DEFAULT_TYPE):
-    """Periodically check for new support requests and notify admins."""
+    """Forward new support requests to admins once the user bot has written to the database."""
+    bot = context.bot
+    seen_version = None
+    # Claims stranded by a restart expire without any new write, so claim again on a timer too
+    next_sweep = time.monotonic() + SUPPORT_CLAIM_TIMEOUT
     while True:
         try:
-            requests = fetch_support_requests()
-            if not requests:
-                await asyncio.sleep(60)
-                continue
-            bot = Bot(ADMIN_BOT_TOKEN)
-            for req in requests:
-                username = req['username'] or 'Не указан'
-                text = (
-                    f"📩 Новый запрос поддержки #{req['id']}\n"
-                    f"Пользователь: @{username} (ID: {req['user_id']})\n"
-                    f"Время: {req['created_at']}\n"
-                    f"Сообщение: {req['content']}"
-                )
-                keyboard = [
-                    [InlineKeyboardButton("🚫 Заблокировать пользователя", callback_data=f"block_user_{req['user_id']}_{req['id']}")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                for admin_id in ADMIN_IDS:
-                    try:
-                        await bot.send_message(
-                            chat_id=admin_id,
-                            text=text,
-                            parse_mode='HTML',
-                            reply_markup=reply_markup
-                        )
-                        logger.info(f"Support request #{req['id']} sent to admin {admin_id}")
-                    except TelegramError as e:
-                        logger.error(f"Error sending support request #{req['id']} to admin {admin_id}: {e}")
-                delete_support_request(req['id'])
+            # data_version only moves when another connection commits, so idle checks read no tables
+            version = await asyncio.to_thread(fetch_scalar, "PRAGMA data_version")
+            if version != seen_version or time.monotonic() >= next_sweep:
+                requests = await asyncio.to_thread(claim_support_requests)
+                seen_version = version
+                next_sweep = time.monotonic() + SUPPORT_CLAIM_TIMEOUT
+                for req in requests:
+                    username = req['username'] or 'Не указан'
+                    text = (
+                        f"📩 Новый запрос поддержки #{req['id']}\n"
+                        f"Пользователь: @{username} (ID: {req['user_id']})\n"
+                        f"Время: {req['created_at']}\n"
+                        f"Сообщение: {req['content']}"
+                    )
+                    keyboard = [
+                        [InlineKeyboardButton("🚫 Заблокировать пользователя", callback_data=f"block_user_{req['user_id']}_{req['id']}")]
+                    ]
+                    reply_markup = InlineKeyboardMarkup(keyboard)
+                    forwarded = False
+                    for admin_id in ADMIN_IDS:
+                        try:
+                            await bot.send_message(
+                                chat_id=admin_id,
+                                text=text,
+                                parse_mode='HTML',
+                                reply_markup=reply_markup
+                            )
+                            forwarded = True
+                            logger.info(f"Support request #{req['id']} sent to admin {admin_id}")
+                        except TelegramError as e:
+                            logger.error(f"Error sending support request #{req['id']} to admin {admin_id}: {e}")
+                    # The request leaves the table only once an admin has it; otherwise retry on the next poll
+                    await asyncio.to_thread(finish_support_request, req['id'], forwarded)
+                    if not forwarded:
+                        seen_version = None
         except Exception as e:
             logger.error(f"Error checking support requests: {e}")
-        await asyncio.sleep(60)  # Check every 60 seconds
+        await asyncio.sleep(SUPPORT_POLL_INTERVAL)
+
+def seconds_until_next_mailing() -> float:
+    """Return how long the mailing worker may sleep before the next mailing is due."""
+    next_send_at = fetch_scalar(SQL_NEXT_MAILING)
+    if not next_send_at:
+        return POLL_INTERVAL
+    delay = next_send_at - time.time()
+    return min(max(delay, 0), POLL_INTERVAL)
 
 async def check_scheduled_mailings(context: ContextTypes.DEFAULT_TYPE):
-    """Periodically check for scheduled mailings."""
+    """Send due mailings, waking early when a new mailing is scheduled."""
     while True:
+        timeout = POLL_INTERVAL
         try:
-            with get_conn() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    """
-                    SELECT id, content, send_at
-                    FROM mailings
-                    WHERE status = 'scheduled' AND send_at <= ?
-                    """,
-                    (datetime.now(),)
-                )
-                mailings = [dict(row) for row in cursor.fetchall()]
+            new_mailing_event.clear()
+            mailings = await asyncio.to_thread(claim_due_mailings)
             for mailing in mailings:
-                logger.info(f"Processing scheduled mailing #{mailing['id']} at {mailing['send_at']}")
+                logger.info(f"Processing scheduled mailing #{mailing['id']} at {format_send_at(mailing['send_at'])}")
                 await send_mailing_directly(mailing['id'], mailing['content'])
+            timeout = await asyncio.to_thread(seconds_until_next_mailing)
         except Exception as e:
             logger.error(f"Error checking scheduled mailings: {e}")
-        await asyncio.sleep(60)  # Check every minute
+        try:
+            await asyncio.wait_for(new_mailing_event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
 
 # --- Handlers ---
 @admin_only
@@ -715,7 +1393,7 @@ async def analytics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /analytics command."""
     msg = get_reply_target(update)
     logger.info(f"Analytics requested by user {update.effective_user.id}")
-    metrics = fetch_metrics()
+    metrics = await asyncio.to_thread(fetch_metrics)
     if not metrics['sales']:
         await msg.reply_text("⚠️ Данные о продажах за последние 30 дней отсутствуют.")
         return
@@ -725,7 +1403,7 @@ async def analytics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         for i, p in enumerate(top_products)
     ) if top_products else "Нет данных о продажах."
     try:
-        export_to_sheets(metrics)
+        await asyncio.to_thread(export_to_sheets, metrics)
         await msg.reply_text(f"{preview}\n\n✅ Данные экспортированы в Google Sheets.")
     except Exception as e:
         await msg.reply_text(f"{preview}\n\n❗ Ошибка экспорта в Google Sheets: {str(e)}")
@@ -735,16 +1413,15 @@ async def catalog_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Display catalog with inline buttons for each product."""
     msg = get_reply_target(update)
     logger.info(f"Catalog requested by user {update.effective_user.id}")
-    prods = fetch_products()
+    try:
+        prods = await asyncio.to_thread(fetch_products)
+    except Exception:
+        await msg.reply_text(DB_ERROR_TEXT, reply_markup=BACK_TO_MAIN)
+        return
     if not prods:
-        await msg.reply_text("📂 Каталог пуст.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data='back_to_main')]]))
+        await msg.reply_text("📂 Каталог пуст.", reply_markup=BACK_TO_MAIN)
         return
-    keyboard = [
-        [InlineKeyboardButton(f"#{p['id']} {p['prod_name']} - {int(p['price'])}₽", callback_data=f"product_{p['id']}")]
-        for p in prods
-    ]
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data='back_to_main')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = cached_keyboard('catalog', prods, build_catalog_keyboard)
     await msg.reply_text("🛍 Выберите товар для просмотра:", reply_markup=reply_markup)
 
 @admin_only
@@ -752,36 +1429,30 @@ async def categories_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Display categories with inline buttons."""
     msg = get_reply_target(update)
     logger.info(f"Categories menu requested by user {update.effective_user.id}")
-    categories = get_categories()
+    try:
+        categories = await asyncio.to_thread(get_categories)
+    except Exception:
+        await msg.reply_text(DB_ERROR_TEXT, reply_markup=BACK_TO_MAIN)
+        return
     if not categories:
-        await msg.reply_text("📋 Категорий нет.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data='back_to_main')]]))
+        await msg.reply_text("📋 Категорий нет.", reply_markup=BACK_TO_MAIN)
         return
-    keyboard = [
-        [InlineKeyboardButton(f"#{c['id']} {c['name']}", callback_data=f"category_{c['id']}")]
-        for c in categories
-    ]
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data='back_to_main')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = cached_keyboard('categories', categories, build_categories_keyboard)
     await msg.reply_text("📋 Выберите категорию для просмотра:", reply_markup=reply_markup)
 
 @admin_only
-async def show_category_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def show_category_details(update: Update, context: ContextTypes.DEFAULT_TYPE, category_id: int):
     """Display category information with delete option."""
     query = update.callback_query
     await query.answer()
-    category_id = int(query.data.split('_')[1])
     logger.info(f"Showing category #{category_id} for user {update.effective_user.id}")
-    category = get_category_by_id(category_id)
+    category = await asyncio.to_thread(get_category_with_count, category_id)
     if not category:
-        await query.message.reply_text("❌ Категория не найдена.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К категориям", callback_data='categories')]]))
+        await query.message.reply_text("❌ Категория не найдена.", reply_markup=BACK_TO_CATEGORIES)
         return
-    with get_conn() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) as product_count FROM all_info WHERE category_id = ?", (category_id,))
-        product_count = cursor.fetchone()['product_count']
     text = (
         f"<b>#{category['id']} {category['name']}</b>\n"
-        f"Товаров в категории: {product_count}\n"
+        f"Товаров в категории: {category['product_count']}\n"
         f"<i>При удалении категории все связанные товары и их медиафайлы будут удалены.</i>"
     )
     keyboard = [
@@ -790,50 +1461,40 @@ async def show_category_details(update: Update, context: ContextTypes.DEFAULT_TY
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     try:
-        await query.message.reply_text(text, parse_mode='HTML', reply_markup=reply_markup)
-        await query.delete_message()
+        await replace_callback_message(query, text, reply_markup, parse_mode='HTML')
     except Exception as e:
         logger.error(f"Error sending category #{category_id}: {e}")
         await query.message.reply_text(text, parse_mode='HTML', reply_markup=reply_markup)
 
 @admin_only
-async def delete_category_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def delete_category_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, category_id: int):
     """Handle category deletion."""
     query = update.callback_query
     await query.answer()
-    category_id = int(query.data.split('_')[2])
     logger.info(f"Deleting category #{category_id} by user {update.effective_user.id}")
     try:
-        delete_category(category_id)
-        await query.message.reply_text(
-            f"✅ Категория #{category_id} удалена.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К категориям", callback_data='categories')]])
-        )
-        await query.delete_message()
+        media_dirs = await asyncio.to_thread(delete_category, category_id)
+        await asyncio.to_thread(remove_media_dirs, media_dirs)
+        await replace_callback_message(query, f"✅ Категория #{category_id} удалена.", BACK_TO_CATEGORIES)
     except ValueError as e:
-        await query.message.reply_text(
-            f"❗ {str(e)}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К категориям", callback_data='categories')]])
-        )
-        await query.delete_message()
+        await replace_callback_message(query, f"❗ {str(e)}", BACK_TO_CATEGORIES)
     except Exception as e:
         logger.error(f"Error in delete_category_handler #{category_id}: {e}")
-        await query.message.reply_text(
-            f"❗ Ошибка при удалении: {str(e)}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К категориям", callback_data='categories')]])
-        )
-        await query.delete_message()
+        await replace_callback_message(query, f"❗ Ошибка при удалении: {str(e)}", BACK_TO_CATEGORIES)
 
 @admin_only
-async def show_product_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def show_product_details(update: Update, context: ContextTypes.DEFAULT_TYPE, product_id: int):
     """Display detailed product information with delete option."""
     query = update.callback_query
     await query.answer()
-    product_id = int(query.data.split('_')[1])
     logger.info(f"Showing product #{product_id} for user {update.effective_user.id}")
-    product = get_product_by_id(product_id)
+    try:
+        product = await asyncio.to_thread(get_product_by_id, product_id)
+    except Exception:
+        await query.message.reply_text("❗ Ошибка при загрузке товара. Попробуйте позже.", reply_markup=BACK_TO_CATALOG)
+        return
     if not product:
-        await query.message.reply_text("❌ Товар не найден.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К каталогу", callback_data='catalog')]]))
+        await query.message.reply_text("❌ Товар не найден.", reply_markup=BACK_TO_CATALOG)
         return
     text = (
         f"<b>#{product['id']} {product['prod_name']}</b>\n"
@@ -848,49 +1509,47 @@ async def show_product_details(update: Update, context: ContextTypes.DEFAULT_TYP
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     try:
-        if product['photo_path'] and os.path.exists(os.path.join(MEDIA_DIR, product['photo_path'])):
-            with open(os.path.join(MEDIA_DIR, product['photo_path']), 'rb') as photo:
-                await query.message.reply_photo(
-                    photo=photo,
-                    caption=text,
-                    parse_mode='HTML',
-                    reply_markup=reply_markup
-                )
+        # A known file_id is resent by reference; otherwise upload from disk once and keep its file_id
+        photo = product['photo_file_id']
+        if not photo and product['photo_path']:
+            photo = await asyncio.to_thread(read_media_file, product['photo_path'])
+        if photo and query.message.photo:
+            sent = await query.edit_message_media(
+                InputMediaPhoto(photo, caption=text, parse_mode='HTML'),
+                reply_markup=reply_markup
+            )
+        elif photo:
+            # Text messages cannot be edited into photos
+            sent = await query.message.reply_photo(
+                photo=photo,
+                caption=text,
+                parse_mode='HTML',
+                reply_markup=reply_markup
+            )
+            await query.delete_message()
         else:
-            await query.message.reply_text(text, parse_mode='HTML', reply_markup=reply_markup)
-        await query.delete_message()
+            await replace_callback_message(query, text, reply_markup, parse_mode='HTML')
+        if photo and not product['photo_file_id']:
+            await asyncio.to_thread(set_product_photo_file_id, product_id, sent.photo[-1].file_id)
     except Exception as e:
         logger.error(f"Error sending product #{product_id}: {e}")
-        await query.message.reply_text(text, parse_mode='HTML', reply_markup=reply_markup)
-        await query.delete_message()
+        await replace_callback_message(query, text, reply_markup, parse_mode='HTML')
 
 @admin_only
-async def delete_product_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def delete_product_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, product_id: int):
     """Handle product deletion."""
     query = update.callback_query
     await query.answer()
-    product_id = int(query.data.split('_')[2])
     logger.info(f"Deleting product #{product_id} by user {update.effective_user.id}")
     try:
-        delete_product(product_id)
-        await query.message.reply_text(
-            f"✅ Товар #{product_id} удалён.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К каталогу", callback_data='catalog')]])
-        )
-        await query.delete_message()
+        media_dirs = await asyncio.to_thread(delete_product, product_id)
+        await asyncio.to_thread(remove_media_dirs, media_dirs)
+        await replace_callback_message(query, f"✅ Товар #{product_id} удалён.", BACK_TO_CATALOG)
     except ValueError as e:
-        await query.message.reply_text(
-            f"❗ {str(e)}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К каталогу", callback_data='catalog')]])
-        )
-        await query.delete_message()
+        await replace_callback_message(query, f"❗ {str(e)}", BACK_TO_CATALOG)
     except Exception as e:
         logger.error(f"Error in delete_product_handler #{product_id}: {e}")
-        await query.message.reply_text(
-            f"❗ Ошибка при удалении: {str(e)}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К каталогу", callback_data='catalog')]])
-        )
-        await query.delete_message()
+        await replace_callback_message(query, f"❗ Ошибка при удалении: {str(e)}", BACK_TO_CATALOG)
 
 @admin_only
 async def add_product_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -901,16 +1560,18 @@ async def add_product_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         msg = update.message
     logger.info(f"Add product started by user {update.effective_user.id}")
-    categories = get_categories()
+    try:
+        categories = await asyncio.to_thread(get_categories)
+    except Exception:
+        await msg.reply_text(DB_ERROR_TEXT, reply_markup=ReplyKeyboardRemove())
+        return ConversationHandler.END
     if not categories:
         await msg.reply_text("📂 Категорий пока нет. Введите название новой категории:", reply_markup=get_back_keyboard())
         logger.info(f"No categories found, transitioning to NEW_CATEGORY for user {update.effective_user.id}")
         return NEW_CATEGORY
-    keyboard = [[InlineKeyboardButton(cat['name'], callback_data=f"cat_{cat['id']}")] for cat in categories]
-    keyboard.append([InlineKeyboardButton("➕ Новая категория", callback_data="new_category")])
     await msg.reply_text(
         "📦 Выберите категорию или создайте новую:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=cached_keyboard('category_choice', categories, build_category_choice_keyboard)
     )
     return CATEGORY_CHOICE
 
@@ -923,8 +1584,8 @@ async def category_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if query.data == "new_category":
         await query.message.reply_text("📂 Введите название новой категории:", reply_markup=get_back_keyboard())
         return NEW_CATEGORY
-    category_id = int(query.data.split("_")[1])
-    context.user_data['category_id'] = category_id
+    category_id = parse_callback_id(query.data)
+    context.user_data.setdefault('add_product', AddProductState()).category_id = category_id
     await query.message.reply_text("🆕 Введите название товара:", reply_markup=get_back_keyboard())
     return PROD_NAME
 
@@ -941,18 +1602,15 @@ async def new_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❗ Название категории не может быть пустым. Введите название:", reply_markup=get_back_keyboard())
         return NEW_CATEGORY
     try:
-        with get_conn() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT id FROM categories WHERE name = ?", (category_name,))
-            existing = cursor.fetchone()
-            if existing:
-                logger.info(f"Category '{category_name}' already exists with ID: {existing['id']}")
-                await update.message.reply_text(
-                    f"❗ Категория '{category_name}' уже существует. Введите другое название:", reply_markup=get_back_keyboard()
-                )
-                return NEW_CATEGORY
-        category_id = create_category(category_name)
-        context.user_data['category_id'] = category_id
+        existing_id = await asyncio.to_thread(get_category_id_by_name, category_name)
+        if existing_id is not None:
+            logger.info(f"Category '{category_name}' already exists with ID: {existing_id}")
+            await update.message.reply_text(
+                f"❗ Категория '{category_name}' уже существует. Введите другое название:", reply_markup=get_back_keyboard()
+            )
+            return NEW_CATEGORY
+        category_id = await asyncio.to_thread(create_category, category_name)
+        context.user_data.setdefault('add_product', AddProductState()).category_id = category_id
         await update.message.reply_text(
             f"✅ Категория '{category_name}' создана (ID: {category_id}).\n🆕 Введите название товара:", reply_markup=get_back_keyboard()
         )
@@ -973,7 +1631,7 @@ async def add_product_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if prod_name == "🔙 Назад":
         await start_command(update, context)
         return ConversationHandler.END
-    context.user_data['prod_name'] = prod_name
+    context.user_data.setdefault('add_product', AddProductState()).prod_name = prod_name
     await update.message.reply_text("📝 Введите описание товара:", reply_markup=get_back_keyboard())
     return PROD_DESC
 
@@ -984,7 +1642,7 @@ async def add_product_desc(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if prod_desc == "🔙 Назад":
         await start_command(update, context)
         return ConversationHandler.END
-    context.user_data['prod_desc'] = prod_desc
+    context.user_data.setdefault('add_product', AddProductState()).prod_desc = prod_desc
     await update.message.reply_text("📏 Укажите размеры (например, 33×45 / 50×50):", reply_markup=get_back_keyboard())
     return PROD_SIZE
 
@@ -994,7 +1652,7 @@ async def add_product_size(update: Update, context: ContextTypes.DEFAULT_TYPE):
     prod_size = update.message.text.strip()
     if prod_size == "🔙 Назад":
         return await start_command(update, context)
-    context.user_data['prod_size'] = prod_size
+    context.user_data.setdefault('add_product', AddProductState()).prod_size = prod_size
     await update.message.reply_text("🔍 Укажите материал (например, хлопок, полиэстер):", reply_markup=get_back_keyboard())
     return PROD_MATERIAL
 
@@ -1004,7 +1662,7 @@ async def add_product_material(update: Update, context: ContextTypes.DEFAULT_TYP
     prod_material = update.message.text.strip()
     if prod_material == "🔙 Назад":
         return await start_command(update, context)
-    context.user_data['prod_material'] = prod_material
+    context.user_data.setdefault('add_product', AddProductState()).prod_material = prod_material
     await update.message.reply_text("💰 Введите цену в рублях (число, например, 1000):", reply_markup=get_back_keyboard())
     return PROD_PRICE
 
@@ -1018,7 +1676,7 @@ async def add_product_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
         price = float(txt)
         if price <= 0:
             raise ValueError("Цена должна быть положительной")
-        context.user_data['prod_price'] = price
+        context.user_data.setdefault('add_product', AddProductState()).prod_price = price
         await update.message.reply_text("📷 Пришлите фото товара:", reply_markup=get_back_keyboard())
         return PROD_PHOTO
     except ValueError:
@@ -1035,37 +1693,21 @@ async def add_product_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message.photo:
         await update.message.reply_text("❗ Ожидается фотография. Пришлите фото товара.", reply_markup=get_back_keyboard())
         return PROD_PHOTO
-    photo_file = await update.message.photo[-1].get_file()
-    file_extension = '.jpg'
-    data = context.user_data
-    required_fields = ['category_id', 'prod_name', 'prod_price', 'prod_desc', 'prod_size', 'prod_material']
-    if not all(k in data for k in required_fields):
+    data = context.user_data.get('add_product')
+    if data is None or not data.is_complete():
         logger.warning(f"Incomplete product data: {data}")
         await update.message.reply_text("❗ Недостаточно данных для создания товара. Попробуйте заново.", reply_markup=get_back_keyboard())
         return ConversationHandler.END
+    photo_size = update.message.photo[-1]
+    file_extension = '.jpg'
     try:
-        with get_conn() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                INSERT INTO all_info (category_id, prod_name, prod_desc, price, size, material)
-                VALUES (?, ?, ?, ?, ?, ?)
-                """,
-                (data['category_id'], data['prod_name'], data['prod_desc'], data['prod_price'], data['prod_size'], data['prod_material'])
-            )
-            product_id = cursor.lastrowid
-        product_dir = os.path.join(MEDIA_DIR, str(product_id))
-        os.makedirs(product_dir, exist_ok=True)
-        photo_filename = f"product_{product_id}{file_extension}"
-        photo_path = os.path.join(str(product_id), photo_filename)
-        full_photo_path = os.path.join(MEDIA_DIR, photo_path)
-        await photo_file.download_to_drive(full_photo_path)
-        with get_conn() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE all_info SET photo_path = ? WHERE id = ?",
-                (photo_path, product_id)
-            )
+        photo_file = await photo_size.get_file()
+        photo = await photo_file.download_as_bytearray()
+        product_id, photo_path = await asyncio.to_thread(
+            create_product_with_photo, data.category_id, data.prod_name, data.prod_price,
+            data.prod_desc, data.prod_size, data.prod_material, photo, file_extension,
+            photo_size.file_id
+        )
         logger.info(f"Product #{product_id} added by user {user_id} with photo at {photo_path}")
         await update.message.reply_text(f"✅ Товар #{product_id} добавлен успешно.", reply_markup=ReplyKeyboardRemove())
         context.user_data.clear()
@@ -1121,17 +1763,16 @@ async def add_promo_start_date(update: Update, context: ContextTypes.DEFAULT_TYP
     txt = update.message.text.strip()
     if txt == "🔙 Назад":
         return await start_command(update, context)
-    try:
-        start_date = datetime.strptime(txt, '%Y-%m-%d').date()
-        if start_date < datetime.now().date():
-            await update.message.reply_text("❗ Дата начала не может быть в прошлом. Введите дату (YYYY-MM-DD):", reply_markup=get_back_keyboard())
-            return PROMO_START
-        context.user_data['promo_start'] = txt
-        await update.message.reply_text("🕒 Введите дату окончания (YYYY-MM-DD):", reply_markup=get_back_keyboard())
-        return PROMO_END
-    except ValueError:
+    start_date = parse_iso_date(txt)
+    if start_date is None:
         await update.message.reply_text("❗ Неверный формат. Введите дату в формате YYYY-MM-DD:", reply_markup=get_back_keyboard())
         return PROMO_START
+    if start_date < date.today():
+        await update.message.reply_text("❗ Дата начала не может быть в прошлом. Введите дату (YYYY-MM-DD):", reply_markup=get_back_keyboard())
+        return PROMO_START
+    context.user_data['promo_start'] = txt
+    await update.message.reply_text("🕒 Введите дату окончания (YYYY-MM-DD):", reply_markup=get_back_keyboard())
+    return PROMO_END
 
 @admin_only
 async def add_promo_end_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1139,40 +1780,39 @@ async def add_promo_end_date(update: Update, context: ContextTypes.DEFAULT_TYPE)
     txt = update.message.text.strip()
     if txt == "🔙 Назад":
         return await start_command(update, context)
-    try:
-        end_date = datetime.strptime(txt, '%Y-%m-%d').date()
-        start_date = datetime.strptime(context.user_data['promo_start'], '%Y-%m-%d').date()
-        if end_date < start_date:
-            await update.message.reply_text(
-                "❗ Дата окончания не может быть раньше даты начала. Введите дату (YYYY-MM-DD):", reply_markup=get_back_keyboard())
-            return PROMO_END
-        data = context.user_data
-        pid = create_promotion(
-            data['promo_name'],
-            data['promo_desc'],
-            data.get('promo_image'),
-            data['promo_start'],
-            txt
-        )
-        await update.message.reply_text(f"✅ Акция #{pid} добавлена.", reply_markup=ReplyKeyboardRemove())
-        context.user_data.clear()
-        return ConversationHandler.END
-    except ValueError:
+    end_date = parse_iso_date(txt)
+    if end_date is None:
         await update.message.reply_text("❗ Неверный формат. Введите дату в формате YYYY-MM-DD:", reply_markup=get_back_keyboard())
         return PROMO_END
+    if end_date < parse_iso_date(context.user_data['promo_start']):
+        await update.message.reply_text(
+            "❗ Дата окончания не может быть раньше даты начала. Введите дату (YYYY-MM-DD):", reply_markup=get_back_keyboard())
+        return PROMO_END
+    data = context.user_data
+    pid = await asyncio.to_thread(
+        create_promotion,
+        data['promo_name'],
+        data['promo_desc'],
+        data.get('promo_image'),
+        data['promo_start'],
+        txt
+    )
+    await update.message.reply_text(f"✅ Акция #{pid} добавлена.", reply_markup=ReplyKeyboardRemove())
+    context.user_data.clear()
+    return ConversationHandler.END
 
 @admin_only
 async def list_promos(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """List all promotions."""
     msg = get_reply_target(update)
-    promos = fetch_promotions()
-    if not promos:
+    try:
+        text = await asyncio.to_thread(fetch_promotions_formatted)
+    except Exception:
+        await msg.reply_text(DB_ERROR_TEXT)
+        return
+    if not text:
         await msg.reply_text("🎁 Акций нет.")
         return
-    text = "\n".join(
-        f"#{p['id']}: {p['name']} ({p['start_date']}–{p['end_date']})\n{p['description'] or 'Без описания'}"
-        for p in promos
-    )
     await msg.reply_text(f"📋 Список акций:\n\n{text}")
 
 @admin_only
@@ -1184,7 +1824,7 @@ async def remove_promo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     promo_id = int(context.args[0])
     try:
-        delete_promotion(promo_id)
+        await asyncio.to_thread(delete_promotion, promo_id)
         await msg.reply_text(f"✅ Акция #{promo_id} удалена.")
     except ValueError as e:
         await msg.reply_text(f"❗ {str(e)}")
@@ -1205,20 +1845,21 @@ async def add_promo_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     promo_code = update.message.text.strip().upper()
     if promo_code == "🔙 Назад":
         return await start_command(update, context)
-    if not promo_code.isalnum():
+    # Non-ASCII characters encode to '?', so anything left after deleting A-Z/0-9 is invalid
+    if not promo_code or promo_code.encode('ascii', 'replace').translate(None, PROMO_CODE_ALLOWED):
         await update.message.reply_text("❗ Промокод должен содержать только латинские буквы и цифры. Попробуйте снова:", reply_markup=get_back_keyboard())
         return PROMO_CODE
-    context.user_data['promo_code'] = promo_code
-    products = fetch_products()
+    context.user_data['add_promo_code'] = AddPromoCodeState(code=promo_code)
+    try:
+        products = await asyncio.to_thread(fetch_products)
+    except Exception:
+        await update.message.reply_text(DB_ERROR_TEXT, reply_markup=ReplyKeyboardRemove())
+        return ConversationHandler.END
     if not products:
         await update.message.reply_text("❗ Нет товаров для привязки. Добавьте товары в каталог.", reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
-    keyboard = [
-        [InlineKeyboardButton(f"#{p['id']} {p['prod_name']}", callback_data=f"promo_product_{p['id']}")]
-        for p in products
-    ]
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data='back_to_main')])
-    await update.message.reply_text("🛍 Выберите товар для акции:", reply_markup=InlineKeyboardMarkup(keyboard))
+    reply_markup = cached_keyboard('promo_product', products, build_promo_product_keyboard)
+    await update.message.reply_text("🛍 Выберите товар для акции:", reply_markup=reply_markup)
     return PROMO_PRODUCT
 
 @admin_only
@@ -1228,9 +1869,9 @@ async def add_promo_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     if query.data == "back_to_main":
         return await start_command(update, context)
-    product_id = int(query.data.split('_')[2])
-    context.user_data['promo_product_id'] = product_id
-    product = get_product_by_id(product_id)
+    product_id = parse_callback_id(query.data)
+    context.user_data['add_promo_code'].product_id = product_id
+    product = await asyncio.to_thread(get_product_by_id, product_id)
     await query.message.reply_text(
         f"Выбран товар: {product['prod_name']}\n💸 Введите процент скидки (число, например, 10):",
         reply_markup=get_back_keyboard()
@@ -1247,7 +1888,7 @@ async def add_promo_discount(update: Update, context: ContextTypes.DEFAULT_TYPE)
         discount = int(txt)
         if not 0 < discount <= 100:
             raise ValueError("Скидка должна быть от 1 до 100%")
-        context.user_data['promo_discount'] = discount
+        context.user_data['add_promo_code'].discount = discount
         await update.message.reply_text("🕒 Введите дату начала акции (YYYY-MM-DD):", reply_markup=get_back_keyboard())
         return PROMO_CODE_START
     except ValueError:
@@ -1260,17 +1901,16 @@ async def add_promo_code_start_date(update: Update, context: ContextTypes.DEFAUL
     txt = update.message.text.strip()
     if txt == "🔙 Назад":
         return await start_command(update, context)
-    try:
-        start_date = datetime.strptime(txt, '%Y-%m-%d').date()
-        if start_date < datetime.now().date():
-            await update.message.reply_text("❗ Дата начала не может быть в прошлом. Введите дату (YYYY-MM-DD):", reply_markup=get_back_keyboard())
-            return PROMO_CODE_START
-        context.user_data['promo_start_date'] = txt
-        await update.message.reply_text("🕒 Введите дату окончания акции (YYYY-MM-DD):", reply_markup=get_back_keyboard())
-        return PROMO_CODE_END
-    except ValueError:
+    start_date = parse_iso_date(txt)
+    if start_date is None:
         await update.message.reply_text("❗ Неверный формат. Введите дату в формате YYYY-MM-DD:", reply_markup=get_back_keyboard())
         return PROMO_CODE_START
+    if start_date < date.today():
+        await update.message.reply_text("❗ Дата начала не может быть в прошлом. Введите дату (YYYY-MM-DD):", reply_markup=get_back_keyboard())
+        return PROMO_CODE_START
+    context.user_data['add_promo_code'].start_date = txt
+    await update.message.reply_text("🕒 Введите дату окончания акции (YYYY-MM-DD):", reply_markup=get_back_keyboard())
+    return PROMO_CODE_END
 
 @admin_only
 async def add_promo_code_end_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1278,22 +1918,25 @@ async def add_promo_code_end_date(update: Update, context: ContextTypes.DEFAULT_
     txt = update.message.text.strip()
     if txt == "🔙 Назад":
         return await start_command(update, context)
+    end_date = parse_iso_date(txt)
+    if end_date is None:
+        await update.message.reply_text("❗ Неверный формат. Введите дату в формате YYYY-MM-DD:", reply_markup=get_back_keyboard())
+        return PROMO_CODE_END
+    data = context.user_data['add_promo_code']
+    if end_date < parse_iso_date(data.start_date):
+        await update.message.reply_text(
+            "❗ Дата окончания не может быть раньше даты начала. Введите дату (YYYY-MM-DD):", reply_markup=get_back_keyboard())
+        return PROMO_CODE_END
     try:
-        end_date = datetime.strptime(txt, '%Y-%m-%d').date()
-        start_date = datetime.strptime(context.user_data['promo_start_date'], '%Y-%m-%d').date()
-        if end_date < start_date:
-            await update.message.reply_text(
-                "❗ Дата окончания не может быть раньше даты начала. Введите дату (YYYY-MM-DD):", reply_markup=get_back_keyboard())
-            return PROMO_CODE_END
-        data = context.user_data
-        promo_id = create_promo_code(
-            data['promo_code'],
-            data['promo_product_id'],
-            data['promo_discount'],
-            data['promo_start_date'],
+        promo_id = await asyncio.to_thread(
+            create_promo_code,
+            data.code,
+            data.product_id,
+            data.discount,
+            data.start_date,
             txt
         )
-        await update.message.reply_text(f"✅ Промокод #{promo_id} ({data['promo_code']}) добавлен.", reply_markup=ReplyKeyboardRemove())
+        await update.message.reply_text(f"✅ Промокод #{promo_id} ({data.code}) добавлен.", reply_markup=ReplyKeyboardRemove())
         context.user_data.clear()
         return ConversationHandler.END
     except ValueError as ve:
@@ -1305,47 +1948,32 @@ async def add_promo_code_end_date(update: Update, context: ContextTypes.DEFAULT_
         return PROMO_CODE_END
 
 @admin_only
-async def list_promo_codes(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Список всех промокодов."""
+async def list_promo_codes(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 0):
+    """Список активных промокодов, по PAGE_SIZE на страницу."""
     msg = get_reply_target(update)
-    promo_codes = fetch_promo_codes()
+    try:
+        promo_codes = await asyncio.to_thread(fetch_promo_codes, page)
+    except Exception:
+        await msg.reply_text(DB_ERROR_TEXT, reply_markup=BACK_TO_MAIN)
+        return
     if not promo_codes:
-        await msg.reply_text("🎟 Нет активных промокодов.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data='back_to_main')]]))
+        await msg.reply_text("🎟 Нет активных промокодов.", reply_markup=BACK_TO_MAIN)
         return
-    keyboard = [
-        [
-            InlineKeyboardButton(f"#{p['id']} {p['code']} ({p['prod_name']}, {p['discount_percentage']}%)", callback_data=f"promo_code_{p['id']}"),
-            InlineKeyboardButton("🗑", callback_data=f"deactivate_promo_{p['id']}")
-        ]
-        for p in promo_codes if p['is_active']
-    ]
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data='back_to_main')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = cached_keyboard(
+        f'promo_codes_{page}', promo_codes, lambda items: build_promo_codes_keyboard(items, page))
     await msg.reply_text("🎟 Список промокодов:", reply_markup=reply_markup)
 
 @admin_only
-async def show_promo_code_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def show_promo_code_details(update: Update, context: ContextTypes.DEFAULT_TYPE, promo_id: int):
     """Показать детали промокода."""
     query = update.callback_query
     await query.answer()
-    promo_id = int(query.data.split('_')[2])
     try:
-        with get_conn() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                SELECT pc.id, pc.code, pc.product_id, p.prod_name, pc.discount_percentage, pc.start_date, pc.end_date, pc.is_active
-                FROM promo_codes pc
-                JOIN all_info p ON pc.product_id = p.id
-                WHERE pc.id = ?
-                """,
-                (promo_id,)
-            )
-            promo = cursor.fetchone()
+        promo = await asyncio.to_thread(get_promo_code, promo_id)
         if not promo:
             await query.message.reply_text(
                 "❌ Промокод не найден.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К промокодам", callback_data='list_promo_codes')]])
+                reply_markup=BACK_TO_PROMO_CODES
             )
             return
         text = (
@@ -1362,53 +1990,43 @@ async def show_promo_code_details(update: Update, context: ContextTypes.DEFAULT_
             [InlineKeyboardButton("🔙 К промокодам", callback_data='list_promo_codes')]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text(text, parse_mode='HTML', reply_markup=reply_markup)
-        await query.delete_message()
+        await replace_callback_message(query, text, reply_markup, parse_mode='HTML')
     except Exception as e:
         logger.error(f"Error showing promo code #{promo_id}: {e}")
         await query.message.reply_text(
             f"❗ Ошибка: {str(e)}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К промокодам", callback_data='list_promo_codes')]])
+            reply_markup=BACK_TO_PROMO_CODES
         )
 
 @admin_only
-async def deactivate_promo_code_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def deactivate_promo_code_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, promo_id: int):
     """Деактивировать промокод."""
     query = update.callback_query
     await query.answer()
-    promo_id = int(query.data.split('_')[2])
     logger.info(f"Deactivating promo code #{promo_id} by user {update.effective_user.id}")
     try:
-        deactivate_promo_code(promo_id)
-        await query.message.reply_text(
-            f"✅ Промокод #{promo_id} деактивирован.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К промокодам", callback_data='list_promo_codes')]])
-        )
-        await query.delete_message()
+        await asyncio.to_thread(deactivate_promo_code, promo_id)
+        await replace_callback_message(query, f"✅ Промокод #{promo_id} деактивирован.", BACK_TO_PROMO_CODES)
     except ValueError as e:
-        await query.message.reply_text(
-            f"❗ {str(e)}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К промокодам", callback_data='list_promo_codes')]])
-        )
-        await query.delete_message()
+        await replace_callback_message(query, f"❗ {str(e)}", BACK_TO_PROMO_CODES)
     except Exception as e:
         logger.error(f"Error deactivating promo code #{promo_id}: {e}")
-        await query.message.reply_text(
-            f"❗ Ошибка при деактивации: {str(e)}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К промокодам", callback_data='list_promo_codes')]])
-        )
-        await query.delete_message()
+        await replace_callback_message(query, f"❗ Ошибка при деактивации: {str(e)}", BACK_TO_PROMO_CODES)
 
 @admin_only
 async def mailing_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start creating a mailing."""
     msg = get_reply_target(update)
-    users = fetch_users()
-    logger.info(f"Starting mailing for user {update.effective_user.id}, found {len(users)} users")
-    if not users:
+    try:
+        user_count = await asyncio.to_thread(fetch_user_count)
+    except Exception:
+        await msg.reply_text(DB_ERROR_TEXT)
+        return ConversationHandler.END
+    logger.info(f"Starting mailing for user {update.effective_user.id}, found {user_count} users")
+    if not user_count:
         await msg.reply_text("❗ Нет пользователей для рассылки. Добавьте пользователей в telegram_profiles.")
         return ConversationHandler.END
-    await msg.reply_text(f"✉️ Введите текст рассылки (будет отправлено {len(users)} пользователям):", reply_markup=get_back_keyboard())
+    await msg.reply_text(f"✉️ Введите текст рассылки (будет отправлено {user_count} пользователям):", reply_markup=get_back_keyboard())
     return MAIL_CONTENT
 
 @admin_only
@@ -1462,16 +2080,8 @@ async def mailing_timer(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(
                 "❗ Ошибка: текст рассылки не найден. Начните заново.", reply_markup=ReplyKeyboardRemove())
             return ConversationHandler.END
-        with get_conn() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                INSERT INTO mailings (content, send_at, status)
-                VALUES (?, ?, 'scheduled')
-                """,
-                (mail_content, send_dt)
-            )
-            mid = cursor.lastrowid
+        mid = await asyncio.to_thread(create_mailing, mail_content, int(send_dt.timestamp()))
+        new_mailing_event.set()
         await update.message.reply_text(
             f"✅ Рассылка #{mid} запланирована на {send_dt.strftime('%Y-%m-%d %H:%M')} через юзер-бота.",
             reply_markup=ReplyKeyboardRemove())
@@ -1490,30 +2100,24 @@ async def mailing_timer(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
 @admin_only
-async def view_mailings(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Display all mailings with delete buttons."""
+async def view_mailings(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 0):
+    """Display a page of mailings with delete buttons."""
     msg = get_reply_target(update)
     try:
-        with get_conn() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                SELECT id, content, send_at, status
-                FROM mailings
-                ORDER BY send_at
-                """
-            )
-            mailings = [dict(row) for row in cursor.fetchall()]
+        mailings = await asyncio.to_thread(fetch_mailings, page)
         if not mailings:
-            await msg.reply_text("✉️ Нет рассылок.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data='back_to_main')]]))
+            await msg.reply_text("✉️ Нет рассылок.", reply_markup=BACK_TO_MAIN)
             return
         keyboard = [
             [
-                InlineKeyboardButton(f"#{m['id']} {m['content'][:20]}... ({m['send_at']})", callback_data=f"mailing_{m['id']}"),
-                InlineKeyboardButton("🗑", callback_data=f"delete_mailing_{m['id']}")
+                InlineKeyboardButton(f"#{mid} {preview}... ({format_send_at(send_at)})", callback_data=f"mailing_{mid}"),
+                InlineKeyboardButton("🗑", callback_data=f"delete_mailing_{mid}")
             ]
-            for m in mailings
+            for mid, preview, send_at in mailings[:PAGE_SIZE]
         ]
+        nav = page_nav_row('view_mailings', page, mailings)
+        if nav:
+            keyboard.append(nav)
         keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data='back_to_main')])
         reply_markup = InlineKeyboardMarkup(keyboard)
         await msg.reply_text("📬 Список рассылок:", reply_markup=reply_markup)
@@ -1522,34 +2126,23 @@ async def view_mailings(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await msg.reply_text(f"❗ Ошибка: {str(e)}")
 
 @admin_only
-async def show_mailing_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def show_mailing_details(update: Update, context: ContextTypes.DEFAULT_TYPE, mailing_id: int):
     """Display mailing details."""
     query = update.callback_query
     await query.answer()
-    mailing_id = int(query.data.split('_')[1])
     logger.info(f"Showing mailing #{mailing_id} for user {update.effective_user.id}")
     try:
-        with get_conn() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                SELECT id, content, send_at, status
-                FROM mailings
-                WHERE id = ?
-                """,
-                (mailing_id,)
-            )
-            mailing = cursor.fetchone()
+        mailing = await asyncio.to_thread(get_mailing, mailing_id)
         if not mailing:
             await query.message.reply_text(
                 "❌ Рассылка не найдена.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К рассылкам", callback_data='view_mailings')]])
+                reply_markup=BACK_TO_MAILINGS
             )
             return
         text = (
             f"<b>Рассылка #{mailing['id']}</b>\n"
             f"Текст: {mailing['content']}\n"
-            f"Время отправки: {mailing['send_at']}\n"
+            f"Время отправки: {format_send_at(mailing['send_at'])}\n"
             f"Статус: {mailing['status']}"
         )
         keyboard = [
@@ -1557,83 +2150,61 @@ async def show_mailing_details(update: Update, context: ContextTypes.DEFAULT_TYP
             [InlineKeyboardButton("🔙 К рассылкам", callback_data='view_mailings')]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text(text, parse_mode='HTML', reply_markup=reply_markup)
-        await query.delete_message()
+        await replace_callback_message(query, text, reply_markup, parse_mode='HTML')
     except Exception as e:
         logger.error(f"Error showing mailing #{mailing_id}: {e}")
         await query.message.reply_text(
             f"❗ Ошибка: {str(e)}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К рассылкам", callback_data='view_mailings')]])
+            reply_markup=BACK_TO_MAILINGS
         )
 
 @admin_only
-async def delete_mailing_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def delete_mailing_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, mailing_id: int):
     """Handle mailing deletion."""
     query = update.callback_query
     await query.answer()
-    mailing_id = int(query.data.split('_')[2])
     logger.info(f"Deleting mailing #{mailing_id} by user {update.effective_user.id}")
     try:
-        delete_mailing(mailing_id)
-        await query.message.reply_text(
-            f"✅ Рассылка #{mailing_id} удалена.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К рассылкам", callback_data='view_mailings')]])
-        )
-        await query.delete_message()
+        await asyncio.to_thread(delete_mailing, mailing_id)
+        await replace_callback_message(query, f"✅ Рассылка #{mailing_id} удалена.", BACK_TO_MAILINGS)
     except ValueError as e:
-        await query.message.reply_text(
-            f"❗ {str(e)}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К рассылкам", callback_data='view_mailings')]])
-        )
-        await query.delete_message()
+        await replace_callback_message(query, f"❗ {str(e)}", BACK_TO_MAILINGS)
     except Exception as e:
         logger.error(f"Error in delete_mailing_handler #{mailing_id}: {e}")
-        await query.message.reply_text(
-            f"❗ Ошибка при удалении: {str(e)}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К рассылкам", callback_data='view_mailings')]])
-        )
-        await query.delete_message()
+        await replace_callback_message(query, f"❗ Ошибка при удалении: {str(e)}", BACK_TO_MAILINGS)
 
 @admin_only
-async def support_requests_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Display current support requests."""
+async def support_requests_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 0):
+    """Display a page of current support requests."""
     msg = get_reply_target(update)
-    logger.info(f"Support requests menu requested by user {update.effective_user.id}")
-    requests = fetch_support_requests()
+    logger.info(f"Support requests page {page} requested by user {update.effective_user.id}")
+    requests = await asyncio.to_thread(fetch_support_requests, page)
     if not requests:
-        await msg.reply_text("📩 Нет активных запросов поддержки.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data='back_to_main')]]))
+        await msg.reply_text("📩 Нет активных запросов поддержки.", reply_markup=BACK_TO_MAIN)
         return
     keyboard = [
-        [InlineKeyboardButton(f"#{r['id']} @{r['username'] or 'N/A'} ({r['created_at']})", callback_data=f"support_{r['id']}")]
-        for r in requests
+        [InlineKeyboardButton(f"#{rid} @{username} ({created_at})", callback_data=f"support_{rid}")]
+        for rid, username, created_at in requests[:PAGE_SIZE]
     ]
+    nav = page_nav_row('support_requests', page, requests)
+    if nav:
+        keyboard.append(nav)
     keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data='back_to_main')])
     reply_markup = InlineKeyboardMarkup(keyboard)
     await msg.reply_text("📩 Выберите запрос поддержки для просмотра:", reply_markup=reply_markup)
 
 @admin_only
-async def show_support_request_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def show_support_request_details(update: Update, context: ContextTypes.DEFAULT_TYPE, request_id: int):
     """Display support request details with block option."""
     query = update.callback_query
     await query.answer()
-    request_id = int(query.data.split('_')[1])
     logger.info(f"Showing support request #{request_id} for user {update.effective_user.id}")
     try:
-        with get_conn() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                SELECT id, user_id, username, content, created_at
-                FROM support_requests
-                WHERE id = ?
-                """,
-                (request_id,)
-            )
-            request = cursor.fetchone()
+        request = await asyncio.to_thread(get_support_request, request_id)
         if not request:
             await query.message.reply_text(
                 "❌ Запрос поддержки не найден.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К запросам", callback_data='support_requests')]])
+                reply_markup=BACK_TO_SUPPORT
             )
             return
         text = (
@@ -1648,70 +2219,41 @@ async def show_support_request_details(update: Update, context: ContextTypes.DEF
             [InlineKeyboardButton("🔙 К запросам", callback_data='support_requests')]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text(text, parse_mode='HTML', reply_markup=reply_markup)
-        await query.delete_message()
+        await replace_callback_message(query, text, reply_markup, parse_mode='HTML')
     except Exception as e:
         logger.error(f"Error showing support request #{request_id}: {e}")
         await query.message.reply_text(
             f"❗ Ошибка: {str(e)}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К запросам", callback_data='support_requests')]])
+            reply_markup=BACK_TO_SUPPORT
         )
 
 @admin_only
-async def delete_support_request_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def delete_support_request_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, request_id: int):
     """Handle support request deletion."""
     query = update.callback_query
     await query.answer()
-    request_id = int(query.data.split('_')[2])
     logger.info(f"Deleting support request #{request_id} by user {update.effective_user.id}")
     try:
-        delete_support_request(request_id)
-        await query.message.reply_text(
-            f"✅ Запрос поддержки #{request_id} удалён.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К запросам", callback_data='support_requests')]])
-        )
-        await query.delete_message()
+        await asyncio.to_thread(delete_support_request, request_id)
+        await replace_callback_message(query, f"✅ Запрос поддержки #{request_id} удалён.", BACK_TO_SUPPORT)
     except ValueError as e:
-        await query.message.reply_text(
-            f"❗ {str(e)}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К запросам", callback_data='support_requests')]])
-        )
-        await query.delete_message()
+        await replace_callback_message(query, f"❗ {str(e)}", BACK_TO_SUPPORT)
     except Exception as e:
         logger.error(f"Error in delete_support_request_handler #{request_id}: {e}")
-        await query.message.reply_text(
-            f"❗ Ошибка при удалении: {str(e)}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К запросам", callback_data='support_requests')]])
-        )
-        await query.delete_message()
+        await replace_callback_message(query, f"❗ Ошибка при удалении: {str(e)}", BACK_TO_SUPPORT)
 
 @admin_only
-async def block_user_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def block_user_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, request_id: int):
     """Handle user blocking."""
     query = update.callback_query
     await query.answer()
-    data = query.data.split('_')
-    user_id = int(data[2])
-    request_id = int(data[3])
     logger.info(f"Blocking user {user_id} from support request #{request_id} by admin {update.effective_user.id}")
     try:
-        with get_conn() as conn:
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM telegram_profiles WHERE telegram_id = ?", (user_id,))
-            cursor.execute("DELETE FROM buy WHERE user_id = ?", (user_id,))
-            cursor.execute("DELETE FROM support_requests WHERE user_id = ?", (user_id,))
-        await query.message.reply_text(
-            f"✅ Пользователь {user_id} заблокирован и все его данные удалены.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К запросам", callback_data='support_requests')]])
-        )
-        await query.delete_message()
+        await asyncio.to_thread(delete_user_data, user_id)
+        await replace_callback_message(query, f"✅ Пользователь {user_id} заблокирован и все его данные удалены.", BACK_TO_SUPPORT)
     except Exception as e:
         logger.error(f"Error blocking user {user_id}: {e}")
-        await query.message.reply_text(
-            f"❗ Ошибка при блокировке пользователя: {str(e)}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К запросам", callback_data='support_requests')]])
-        )
-        await query.delete_message()
+        await replace_callback_message(query, f"❗ Ошибка при блокировке пользователя: {str(e)}", BACK_TO_SUPPORT)
 
 @admin_only
 async def mailing_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1721,6 +2263,57 @@ async def mailing_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🚫 Действие отменено.", reply_markup=ReplyKeyboardRemove())
     return await start_command(update, context)
 
+# Handlers for fixed callback data
+CALLBACK_HANDLERS = {
+    "analytics": analytics_command,
+    "promos": add_promo_start,
+    "promo_codes": list_promo_codes,
+    "list_promo_codes": list_promo_codes,
+    "catalog": catalog_menu,
+    "categories": categories_menu,
+    "mailing": mailing_start,
+    "add_product": add_product_start,
+    "view_mailings": view_mailings,
+    "support_requests": support_requests_menu,
+    "back_to_main": start_command,
+}
+
+# Handlers for "<kind>_<id>" callbacks; they receive the parsed id (a page number for listings)
+CALLBACK_ROUTES = {
+    "promo_codes": list_promo_codes,
+    "view_mailings": view_mailings,
+    "support_requests": support_requests_menu,
+    "product": show_product_details,
+    "category": show_category_details,
+    "promo_code": show_promo_code_details,
+    "mailing": show_mailing_details,
+    "support": show_support_request_details,
+    "delete_product": delete_product_handler,
+    "delete_category": delete_category_handler,
+    "deactivate_promo": deactivate_promo_code_handler,
+    "delete_mailing": delete_mailing_handler,
+    "delete_support": delete_support_request_handler,
+}
+
+# Identical callbacks from the same user within this window are dropped as double taps (seconds)
+CALLBACK_DEBOUNCE = 1.0
+
+# (user_id, callback data) -> monotonic time of the last accepted press
+_recent_callbacks = {}
+
+def is_repeated_callback(user_id: int, data: str) -> bool:
+    """Record a button press; return True if the same press was accepted moments ago."""
+    now = time.monotonic()
+    key = (user_id, data)
+    last = _recent_callbacks.get(key)
+    if last is not None and now - last < CALLBACK_DEBOUNCE:
+        return True
+    if len(_recent_callbacks) > 256:
+        for stale in [k for k, t in _recent_callbacks.items() if now - t >= CALLBACK_DEBOUNCE]:
+            del _recent_callbacks[stale]
+    _recent_callbacks[key] = now
+    return False
+
 @admin_only
 async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle callback queries."""
@@ -1728,61 +2321,52 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = query.data
     user_id = update.effective_user.id
     logger.info(f"Callback '{data}' from user {user_id}")
+    repeated = is_repeated_callback(user_id, data)
     try:
-        await query.answer()
+        await query.answer("⏳" if repeated else None)
     except BadRequest as e:
         if "query is too old" not in str(e):
             logger.warning(f"BadRequest on callback answer: {e}")
-    if user_id not in ADMIN_IDS:
-        await query.message.reply_text("❌ Доступ запрещён.")
+    if repeated:
+        logger.info(f"Dropped repeated callback '{data}' from user {user_id}")
+        return
+    handler = CALLBACK_HANDLERS.get(data)
+    if handler is not None:
+        await handler(update, context)
         return
-    match data:
-        case "analytics":
-            await analytics_command(update, context)
-        case "promos":
-            await add_promo_start(update, context)
-        case "promo_codes":
-            await list_promo_codes(update, context)
-        case "catalog":
-            await catalog_menu(update, context)
-        case "categories":
-            await categories_menu(update, context)
-        case "mailing":
-            await mailing_start(update, context)
-        case "add_product":
-            await add_product_start(update, context)
-        case "view_mailings":
-            await view_mailings(update, context)
-        case "support_requests":
-            await support_requests_menu(update, context)
-        case data if data.startswith("support_"):
-            await show_support_request_details(update, context)
-        case data if data.startswith("delete_support_"):
-            await delete_support_request_handler(update, context)
-        case data if data.startswith("block_user_"):
-            await block_user_handler(update, context)
-        case data if data.startswith("product_"):
-            await show_product_details(update, context)
-        case data if data.startswith("delete_product_"):
-            await delete_product_handler(update, context)
-        case data if data.startswith("category_"):
-            await show_category_details(update, context)
-        case data if data.startswith("delete_category_"):
-            await delete_category_handler(update, context)
-        case data if data.startswith("mailing_"):
-            await show_mailing_details(update, context)
-        case data if data.startswith("delete_mailing_"):
-            await delete_mailing_handler(update, context)
-        case data if data.startswith("promo_code_"):
-            await show_promo_code_details(update, context)
-        case data if data.startswith("deactivate_promo_"):
-            await deactivate_promo_code_handler(update, context)
-        case data if data.startswith("list_promo_codes"):
-            await list_promo_codes(update, context)
-        case data if data.startswith("back_to_main"):
-            await start_command(update, context)
-        case _:
-            await category_choice(update, context)
+    routed = CALLBACK_ID_RE.match(data)
+    if routed and routed['kind'] in CALLBACK_ROUTES:
+        await CALLBACK_ROUTES[routed['kind']](update, context, int(routed['id']))
+    elif data.startswith("block_user_"):
+        # "block_user_<user_id>_<request_id>"
+        blocked_id, request_id = map(int, data[len("block_user_"):].split('_'))
+        await block_user_handler(update, context, blocked_id, request_id)
+    else:
+        await category_choice(update, context)
+
+# --- Update Processing ---
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Handle updates concurrently across chats while keeping each chat in order."""
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # Locks are dropped once no update for the chat holds or waits on them
+        self._chat_locks = weakref.WeakValueDictionary()
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        chat_id = chat.id if chat else None
+        lock = self._chat_locks.get(chat_id)
+        if lock is None:
+            lock = self._chat_locks[chat_id] = asyncio.Lock()
+        async with lock:
+            await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
 
 # --- Main ---
 def main():
@@ -1790,24 +2374,33 @@ def main():
     try:
         logger.info("Starting admin bot")
         init_db()
-        app = ApplicationBuilder().token(ADMIN_BOT_TOKEN).build()
+        # No mailing can be in progress yet, so any 'sending' row was cut off by a crash or restart
+        interrupted = fail_interrupted_mailings()
+        if interrupted:
+            logger.warning(f"Marked {interrupted} interrupted mailing(s) as failed")
+        app = (
+            ApplicationBuilder()
+            .token(ADMIN_BOT_TOKEN)
+            .concurrent_updates(PerChatUpdateProcessor(UPDATE_CONCURRENCY))
+            .build()
+        )
 
         # Product addition conversation handler
         conv_handler = ConversationHandler(
             entry_points=[CallbackQueryHandler(add_product_start, pattern="^add_product$")],
             states={
                 CATEGORY_CHOICE: [CallbackQueryHandler(category_choice)],
-                NEW_CATEGORY: [MessageHandler(filters.TEXT & ~filters.COMMAND, new_category)],
-                PROD_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_product_name)],
-                PROD_DESC: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_product_desc)],
-                PROD_SIZE: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_product_size)],
-                PROD_MATERIAL: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_product_material)],
-                PROD_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_product_price)],
-                PROD_PHOTO: [MessageHandler(filters.PHOTO | filters.TEXT & ~filters.COMMAND, add_product_photo)],
+                NEW_CATEGORY: [MessageHandler(TEXT_NOCMD, new_category)],
+                PROD_NAME: [MessageHandler(TEXT_NOCMD, add_product_name)],
+                PROD_DESC: [MessageHandler(TEXT_NOCMD, add_product_desc)],
+                PROD_SIZE: [MessageHandler(TEXT_NOCMD, add_product_size)],
+                PROD_MATERIAL: [MessageHandler(TEXT_NOCMD, add_product_material)],
+                PROD_PRICE: [MessageHandler(TEXT_NOCMD, add_product_price)],
+                PROD_PHOTO: [MessageHandler(filters.PHOTO | TEXT_NOCMD, add_product_photo)],
             },
             fallbacks=[
                 CommandHandler('cancel', mailing_cancel),
-                MessageHandler(filters.Regex('^🔙 Назад$'), mailing_cancel)
+                MessageHandler(BACK_FILTER, mailing_cancel)
             ],
             per_chat=True,
             per_user=True,
@@ -1818,15 +2411,15 @@ def main():
         promo_conv = ConversationHandler(
             entry_points=[CallbackQueryHandler(add_promo_start, pattern="^promos$")],
             states={
-                PROMO_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_promo_name)],
-                PROMO_DESC: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_promo_desc)],
-                PROMO_IMAGE: [MessageHandler(filters.PHOTO | filters.TEXT & ~filters.COMMAND, add_promo_image)],
-                PROMO_START: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_promo_start_date)],
-                PROMO_END: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_promo_end_date)],
+                PROMO_NAME: [MessageHandler(TEXT_NOCMD, add_promo_name)],
+                PROMO_DESC: [MessageHandler(TEXT_NOCMD, add_promo_desc)],
+                PROMO_IMAGE: [MessageHandler(filters.PHOTO | TEXT_NOCMD, add_promo_image)],
+                PROMO_START: [MessageHandler(TEXT_NOCMD, add_promo_start_date)],
+                PROMO_END: [MessageHandler(TEXT_NOCMD, add_promo_end_date)],
             },
             fallbacks=[
                 CommandHandler('cancel', mailing_cancel),
-                MessageHandler(filters.Regex('^🔙 Назад$'), mailing_cancel)
+                MessageHandler(BACK_FILTER, mailing_cancel)
             ],
             per_chat=True,
             per_user=True,
@@ -1837,15 +2430,15 @@ def main():
         promo_code_conv = ConversationHandler(
             entry_points=[CallbackQueryHandler(add_promo_code_start, pattern="^promo_codes$")],
             states={
-                PROMO_CODE: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_promo_code)],
+                PROMO_CODE: [MessageHandler(TEXT_NOCMD, add_promo_code)],
                 PROMO_PRODUCT: [CallbackQueryHandler(add_promo_product)],
-                PROMO_DISCOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_promo_discount)],
-                PROMO_CODE_START: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_promo_code_start_date)],
-                PROMO_CODE_END: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_promo_code_end_date)],
+                PROMO_DISCOUNT: [MessageHandler(TEXT_NOCMD, add_promo_discount)],
+                PROMO_CODE_START: [MessageHandler(TEXT_NOCMD, add_promo_code_start_date)],
+                PROMO_CODE_END: [MessageHandler(TEXT_NOCMD, add_promo_code_end_date)],
             },
             fallbacks=[
                 CommandHandler('cancel', mailing_cancel),
-                MessageHandler(filters.Regex('^🔙 Назад$'), mailing_cancel)
+                MessageHandler(BACK_FILTER, mailing_cancel)
             ],
             per_chat=True,
             per_user=True,
@@ -1856,12 +2449,12 @@ def main():
         mailing_conv = ConversationHandler(
             entry_points=[CallbackQueryHandler(mailing_start, pattern="^mailing$")],
             states={
-                MAIL_CONTENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, mailing_content)],
-                MAIL_TIMER: [MessageHandler(filters.TEXT & ~filters.COMMAND, mailing_timer)],
+                MAIL_CONTENT: [MessageHandler(TEXT_NOCMD, mailing_content)],
+                MAIL_TIMER: [MessageHandler(TEXT_NOCMD, mailing_timer)],
             },
             fallbacks=[
                 CommandHandler('cancel', mailing_cancel),
-                MessageHandler(filters.Regex('^🔙 Назад$'), mailing_cancel)
+                MessageHandler(BACK_FILTER, mailing_cancel)
             ],
             per_chat=True,
             per_user=True,
@@ -1878,9 +2471,9 @@ def main():
         app.add_handler(mailing_conv)
         app.add_handler(CallbackQueryHandler(on_callback))
 
-        # Start periodic jobs
-        app.job_queue.run_repeating(check_support_requests, interval=60, first=10)
-        app.job_queue.run_repeating(check_scheduled_mailings, interval=60, first=10)
+        # Start background workers; each loops on its own schedule
+        app.job_queue.run_once(check_support_requests, when=10)
+        app.job_queue.run_once(check_scheduled_mailings, when=10)
 
         logger.info("Bot is running...")
         app.run_polling(allowed_updates=Update.ALL_TYPES)
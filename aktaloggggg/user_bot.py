@@ -1,29 +1,48 @@
 import asyncio
+import atexit
 import os
 import logging
+import logging.handlers
+import queue
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler, MessageHandler,
-    ContextTypes, filters, ChatJoinRequestHandler, ConversationHandler
+    ContextTypes, filters, ChatJoinRequestHandler, ChatMemberHandler, ConversationHandler
 )
-from datetime import datetime
+from datetime import datetime, timezone
 from contextlib import contextmanager
+from cachetools import TTLCache
+from cachetools.func import ttl_cache
 import sqlite3
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove,
+    InputMediaPhoto
+)
 from telegram.error import Conflict, BadRequest, Forbidden
+from telegram.request import HTTPXRequest
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
 # Configure logging
+# Records are formatted by the QueueHandler and written by a listener thread,
+# so file and console I/O never runs on the event loop.
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(
+    log_queue,
+    logging.FileHandler('user_bot.log'),
+    logging.StreamHandler()
+)
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG,
-    handlers=[
-        logging.FileHandler('user_bot.log'),
-        logging.StreamHandler()
-    ]
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    handlers=[logging.handlers.QueueHandler(log_queue)]
 )
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # Environment variables
@@ -31,39 +50,173 @@ ADMIN_IDS = {int(x) for x in os.getenv('ADMIN_IDS', '').split(',') if x}
 TOKEN = os.getenv('USER_BOT_TOKEN', '')
 DB_PATH = os.getenv('DB_PATH', 'bot.db')
 MEDIA_DIR = os.getenv('MEDIA_DIR', 'media')
+# Public HTTPS base URL; when set, updates are received by webhook instead of polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or None
 
 # Ensure media directory exists
 os.makedirs(MEDIA_DIR, exist_ok=True)
 
+# HTTP connections for Bot API calls; getUpdates gets its own small pool so
+# long polling never holds a connection that replies are waiting for
+API_POOL_SIZE = 64
+UPDATES_POOL_SIZE = 4
+# How long a request may wait for a free pooled connection (seconds)
+POOL_TIMEOUT = 20
+
+# How long catalog reads stay cached; admin bot edits show up within this window (seconds).
+# Cached readers raise on database errors and their *_async wrappers fall back,
+# so a failed read is never cached.
+CATALOG_CACHE_TTL = 60
+
+# How long settings stay cached; local updates clear the cache immediately (seconds)
+SETTINGS_CACHE_TTL = 30
+
+# How long a user's blocked flag is cached; blocks are made by the admin bot (seconds)
+BLOCKED_CACHE_TTL = 60
+
+# How long the bot's own channel permissions are cached; changes to its
+# membership drop the entry right away (seconds)
+PERMISSIONS_CACHE_TTL = 300
+
 # Back button keyboard
 BACK_BUTTON = [[KeyboardButton("🔙 Назад")]]
 
+# Reply markups are immutable, so every reply shares one instance
+BACK_KEYBOARD = ReplyKeyboardMarkup(BACK_BUTTON, resize_keyboard=True)
+REMOVE_KEYBOARD = ReplyKeyboardRemove()
+
 # States for ConversationHandler
 PROMO_CODE_INPUT = 1
+SUPPORT_MESSAGE_INPUT = 2
+
+# Message filters shared by handlers
+BACK_FILTER = filters.Regex(re.compile(r'^🔙 Назад$'))
+TEXT_NOCMD = filters.TEXT & ~filters.COMMAND
+
+# --- Menu Keyboards ---
+# Built markups keyed by menu name, reused while the cached listing object is the same
+_keyboard_cache = {}
+
+def cached_keyboard(name: str, items: list, build) -> InlineKeyboardMarkup:
+    """Return build(items), rebuilding only when the listing cache hands out a new list."""
+    cached = _keyboard_cache.get(name)
+    if cached is not None and cached[0] is items:
+        return cached[1]
+    reply_markup = build(items)
+    _keyboard_cache[name] = (items, reply_markup)
+    return reply_markup
+
+def build_catalog_keyboard(categories: list) -> InlineKeyboardMarkup:
+    """One button per category plus Back."""
+    keyboard = [
+        [InlineKeyboardButton(category['name'], callback_data=f'category_{category["id"]}')]
+        for category in categories
+    ]
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data='back_to_main')])
+    return InlineKeyboardMarkup(keyboard)
+
+def build_category_products_keyboard(products: list) -> InlineKeyboardMarkup:
+    """One button per product with its price, plus Back to the catalog."""
+    keyboard = [
+        [InlineKeyboardButton(f"{p['prod_name']} - {int(p['price'])}₽", callback_data=f'product_{p["id"]}')]
+        for p in products
+    ]
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data='catalog_main')])
+    return InlineKeyboardMarkup(keyboard)
 
 # --- Database Connection ---
+# Per-connection tuning; journal_mode=WAL persists in the file and is set once in init_db()
+DB_PRAGMAS = """
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-20000;
+    PRAGMA mmap_size=134217728;
+"""
+
+# Idle reader connections kept open between calls
+READ_POOL_SIZE = 8
+
+# Threads reserved for the *_async wrappers, so DB calls never queue behind other blocking work
+DB_WORKERS = 4
+
+_read_pool = queue.LifoQueue(maxsize=READ_POOL_SIZE)
+_db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+_writer = None
+_writer_lock = threading.Lock()
+
+def run_db(func, *args):
+    """Run a blocking DB helper on the dedicated executor and return an awaitable for its result."""
+    return asyncio.get_running_loop().run_in_executor(_db_executor, func, *args)
+
+def _open_conn():
+    """Open a tuned connection that executor threads can share."""
+    conn = sqlite3.connect(DB_PATH, timeout=10, check_same_thread=False, cached_statements=256)
+    conn.executescript(DB_PRAGMAS)
+    conn.row_factory = sqlite3.Row
+    return conn
+
 @contextmanager
-def get_conn():
-    """Context manager for SQLite connections."""
+def get_read_conn():
+    """Borrow a pooled connection for SELECT-only work; its page cache stays warm between calls."""
+    try:
+        conn = _read_pool.get_nowait()
+    except queue.Empty:
+        conn = _open_conn()
     try:
-        conn = sqlite3.connect(DB_PATH, timeout=10)
-        conn.row_factory = sqlite3.Row
         yield conn
-        conn.commit()
-    except sqlite3.OperationalError as e:
-        logger.error(f"Database error: {e}")
-        raise
-    except Exception:
-        conn.rollback()
-        raise
     finally:
-        conn.close()
+        try:
+            _read_pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+@contextmanager
+def get_write_conn():
+    """Context manager for the single writer connection; commits on success."""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = _open_conn()
+        try:
+            yield _writer
+            _writer.commit()
+        except sqlite3.OperationalError as e:
+            logger.error(f"Database error: {e}")
+            _writer.rollback()
+            raise
+        except Exception:
+            _writer.rollback()
+            raise
+
+# --- Hot SQL Statements ---
+# Kept as module constants so each pooled connection's statement cache reuses
+# the compiled statements instead of re-preparing them on every update.
+SQL_IS_BLOCKED = "SELECT 1 FROM blocked_users WHERE user_id = ?"
+SQL_GET_SETTING = "SELECT value FROM settings WHERE key = ?"
+SQL_GET_PRODUCT = """
+    SELECT prod_name, price, prod_desc, size, material, photo_path, user_photo_file_id
+    FROM all_info
+    WHERE id = ?
+"""
+SQL_FIND_CART_PROMO_CODE = """
+    SELECT id, product_id
+    FROM promo_codes
+    WHERE code = ? AND is_active = 1
+    AND start_date <= ? AND end_date >= ?
+    AND product_id IN (SELECT product_id FROM buy WHERE user_id = ?)
+"""
+SQL_ADD_TO_CART = "INSERT INTO buy (user_id, product_id, promo_code_id) VALUES (?, ?, ?)"
+SQL_REGISTER_USER = "INSERT OR IGNORE INTO telegram_profiles (telegram_id, username) VALUES (?, ?)"
+SQL_LOG_JOIN_REQUEST = "INSERT INTO join_requests (user_id, username, status) VALUES (?, ?, ?)"
 
 # Initialize database
 def init_db():
     """Initialize database schema with all necessary tables."""
     try:
-        with get_conn() as conn:
+        with get_write_conn() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
             cursor = conn.cursor()
             cursor.executescript("""
                 CREATE TABLE IF NOT EXISTS categories (
@@ -79,6 +232,7 @@ def init_db():
                     size TEXT,
                     material TEXT,
                     photo_path TEXT,
+                    user_photo_file_id TEXT,
                     FOREIGN KEY (category_id) REFERENCES categories(id)
                 );
                 CREATE TABLE IF NOT EXISTS buy (
@@ -125,6 +279,7 @@ def init_db():
                     username TEXT,
                     content TEXT NOT NULL,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    claimed_at INTEGER,
                     FOREIGN KEY (user_id) REFERENCES telegram_profiles(telegram_id)
                 );
                 CREATE TABLE IF NOT EXISTS join_requests (
@@ -140,33 +295,31 @@ def init_db():
                     value TEXT NOT NULL
                 );
                 INSERT OR IGNORE INTO settings (key, value) VALUES ('restrict_keyboard_to_admins', '0');
+                CREATE INDEX IF NOT EXISTS idx_buy_user ON buy(user_id);
+                CREATE INDEX IF NOT EXISTS idx_allinfo_cat ON all_info(category_id);
+                CREATE INDEX IF NOT EXISTS idx_promotions_dates ON promotions(start_date, end_date);
+                CREATE INDEX IF NOT EXISTS idx_support_user ON support_requests(user_id);
             """)
+            # file_ids are per bot, so the user bot keeps its own column next to the admin bot's photo_file_id
+            cursor.execute("PRAGMA table_info(all_info)")
+            if 'user_photo_file_id' not in {row['name'] for row in cursor.fetchall()}:
+                cursor.execute("ALTER TABLE all_info ADD COLUMN user_photo_file_id TEXT")
+            # Refresh planner statistics for tables that changed enough to need it
+            conn.execute("PRAGMA optimize")
             logger.info("Database initialized successfully")
     except Exception as e:
         logger.error(f"Failed to initialize database: {e}")
         raise
 
 # --- Database Functions ---
-def register_user(telegram_id: int, username: str = None) -> bool:
-    """Register a user in the database."""
-    try:
-        with get_conn() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT OR IGNORE INTO telegram_profiles (telegram_id, username) VALUES (?, ?)",
-                (telegram_id, username)
-            )
-            return cursor.rowcount > 0 or cursor.execute(
-                "SELECT 1 FROM telegram_profiles WHERE telegram_id = ?", (telegram_id,)
-            ).fetchone() is not None
-    except Exception as e:
-        logger.error(f"Error registering user {telegram_id}: {e}")
-        return False
+def utc_today() -> str:
+    """Today's UTC date as YYYY-MM-DD, matching SQLite's date('now')."""
+    return datetime.now(timezone.utc).date().isoformat()
 
 def save_support_request(user_id: int, username: str, content: str) -> int:
     """Save a support request to the database."""
     try:
-        with get_conn() as conn:
+        with get_write_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO support_requests (user_id, username, content) VALUES (?, ?, ?)",
@@ -177,22 +330,10 @@ def save_support_request(user_id: int, username: str, content: str) -> int:
         logger.error(f"Error saving support request for user {user_id}: {e}")
         raise
 
-def log_join_request(user_id: int, username: str, status: str):
-    """Log join request to the database."""
-    try:
-        with get_conn() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO join_requests (user_id, username, status) VALUES (?, ?, ?)",
-                (user_id, username, status)
-            )
-    except Exception as e:
-        logger.error(f"Error logging join request for {user_id}: {e}")
-
 def clear_user_cart(user_id: int) -> bool:
     """Clear user's cart."""
     try:
-        with get_conn() as conn:
+        with get_write_conn() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM buy WHERE user_id = ?", (user_id,))
             return True
@@ -200,95 +341,146 @@ def clear_user_cart(user_id: int) -> bool:
         logger.error(f"Error clearing cart for user {user_id}: {e}")
         return False
 
+@ttl_cache(maxsize=1, ttl=CATALOG_CACHE_TTL)
 def get_categories() -> list:
     """Retrieve all categories."""
     try:
-        with get_conn() as conn:
+        with get_read_conn() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT id, name FROM categories ORDER BY name")
-            return [dict(row) for row in cursor.fetchall()]
+            return cursor.fetchall()
     except Exception as e:
         logger.error(f"Error fetching categories: {e}")
-        return []
+        raise
 
 def get_promotions() -> list:
     """Retrieve active promotions."""
+    today = utc_today()
     try:
-        with get_conn() as conn:
+        with get_read_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
                 SELECT id, name, description, image_url, start_date, end_date
                 FROM promotions
-                WHERE start_date <= date('now') AND end_date >= date('now')
+                WHERE start_date <= ? AND end_date >= ?
                 ORDER BY start_date
-                """
+                """,
+                (today, today)
             )
-            return [dict(row) for row in cursor.fetchall()]
+            return cursor.fetchall()
     except Exception as e:
         logger.error(f"Error fetching promotions: {e}")
-        return None
+        raise
+
+@ttl_cache(maxsize=1, ttl=CATALOG_CACHE_TTL)
+def get_promotions_view() -> tuple:
+    """Active promotions rendered as (text, photos); text is None when there are none.
+
+    Database errors propagate so a failed read is not cached as "no promotions".
+    """
+    promos = get_promotions()
+    if not promos:
+        return None, []
+    text = "🎁 Текущие акции:\n\n" + "\n\n".join(
+        f"📌 {p['name']}\n{p['description'] or 'Без описания'}\n🕒 {p['start_date']}–{p['end_date']}"
+        for p in promos
+    )
+    photos = [
+        InputMediaPhoto(p['image_url'], caption=f"{p['name']}\n{p['description'] or ''}")
+        for p in promos if p['image_url']
+    ]
+    return text, photos
 
-def get_products_by_category(category_id: int) -> list:
-    """Retrieve products by category ID."""
+@ttl_cache(maxsize=256, ttl=CATALOG_CACHE_TTL)
+def get_category_with_products(category_id: int) -> tuple:
+    """Retrieve (category name, products) in one query; the name is None for an unknown category."""
     try:
-        with get_conn() as conn:
+        with get_read_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
-                SELECT id, prod_name, price, prod_desc
-                FROM all_info
-                WHERE category_id = ?
+                SELECT c.name, ai.id, ai.prod_name, ai.price, ai.prod_desc
+                FROM categories c
+                LEFT JOIN all_info ai ON ai.category_id = c.id
+                WHERE c.id = ?
                 """,
                 (category_id,)
             )
-            return [dict(row) for row in cursor.fetchall()]
+            rows = cursor.fetchall()
+            if not rows:
+                return None, []
+            products = [
+                {'id': row['id'], 'prod_name': row['prod_name'], 'price': row['price'], 'prod_desc': row['prod_desc']}
+                for row in rows if row['id'] is not None
+            ]
+            return rows[0]['name'], products
     except Exception as e:
-        logger.error(f"Error fetching products for category {category_id}: {e}")
-        return []
+        logger.error(f"Error fetching category {category_id} with products: {e}")
+        raise
 
-def get_product_by_id(product_id: int) -> dict:
+@ttl_cache(maxsize=1024, ttl=CATALOG_CACHE_TTL)
+def get_product_by_id(product_id: int) -> sqlite3.Row:
     """Retrieve product details by ID."""
     try:
-        with get_conn() as conn:
+        with get_read_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                """
-                SELECT prod_name, price, prod_desc, size, material, photo_path
-                FROM all_info
-                WHERE id = ?
-                """,
-                (product_id,)
-            )
-            row = cursor.fetchone()
-            return dict(row) if row else None
+            cursor.execute(SQL_GET_PRODUCT, (product_id,))
+            return cursor.fetchone()
     except Exception as e:
         logger.error(f"Error fetching product {product_id}: {e}")
-        return None
+        raise
+
+def set_product_photo_file_id(product_id: int, file_id: str):
+    """Remember the Telegram file_id of a product photo uploaded by this bot."""
+    try:
+        with get_write_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE all_info SET user_photo_file_id = ? WHERE id = ?", (file_id, product_id))
+        get_product_by_id.cache_clear()
+    except Exception as e:
+        logger.error(f"Error saving photo file_id for product {product_id}: {e}")
 
 def add_product_to_cart(user_id: int, product_id: int, promo_code_id: int = None) -> bool:
     """Add a product to the user's cart with optional promo code."""
     try:
-        with get_conn() as conn:
+        with get_write_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO buy (user_id, product_id, promo_code_id) VALUES (?, ?, ?)",
-                (user_id, product_id, promo_code_id)
-            )
+            cursor.execute(SQL_ADD_TO_CART, (user_id, product_id, promo_code_id))
             return cursor.rowcount > 0
     except Exception as e:
         logger.error(f"Error adding product {product_id} to cart for user {user_id}: {e}")
         return False
 
+def apply_promo_code_to_cart(user_id: int, code: str):
+    """Attach a valid promo code to the matching cart entries; return the product id, or None if it does not apply."""
+    try:
+        with get_write_conn() as conn:
+            cursor = conn.cursor()
+            today = utc_today()
+            cursor.execute(SQL_FIND_CART_PROMO_CODE, (code.upper(), today, today, user_id))
+            promo = cursor.fetchone()
+            if not promo:
+                return None
+            cursor.execute(
+                "UPDATE buy SET promo_code_id = ? WHERE user_id = ? AND product_id = ?",
+                (promo['id'], user_id, promo['product_id'])
+            )
+            return promo['product_id']
+    except Exception as e:
+        logger.error(f"Error applying promo code {code} to cart of user {user_id}: {e}")
+        return None
+
 def get_user_cart(user_id: int) -> list:
     """Retrieve user's cart contents with promo code details."""
     try:
-        with get_conn() as conn:
+        with get_read_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
                 SELECT b.id, ai.id AS product_id, ai.prod_name, ai.price, pc.id AS promo_code_id,
-                       pc.code, pc.discount_percentage
+                       pc.code, pc.discount_percentage,
+                       ai.price * (1 - COALESCE(pc.discount_percentage, 0) / 100.0) AS effective_price
                 FROM buy b
                 JOIN all_info ai ON b.product_id = ai.id
                 LEFT JOIN promo_codes pc ON b.promo_code_id = pc.id
@@ -296,169 +488,248 @@ def get_user_cart(user_id: int) -> list:
                 """,
                 (user_id,)
             )
-            return [dict(row) for row in cursor.fetchall()]
+            return cursor.fetchall()
     except Exception as e:
         logger.error(f"Error fetching cart for user {user_id}: {e}")
         return []
 
+@ttl_cache(maxsize=4096, ttl=BLOCKED_CACHE_TTL)
 def is_blocked(user_id: int) -> bool:
-    """Check if a user is blocked."""
+    """Check if a user is blocked; errors propagate so a failed check is never cached."""
     try:
-        with get_conn() as conn:
+        with get_read_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT 1 FROM blocked_users WHERE user_id = ?", (user_id,))
+            cursor.execute(SQL_IS_BLOCKED, (user_id,))
             return cursor.fetchone() is not None
     except Exception as e:
         logger.error(f"Error checking if user {user_id} is blocked: {e}")
-        return False
-
-def validate_promo_code(code: str, product_id: int) -> dict:
-    """Validate a promo code for a specific product."""
-    try:
-        with get_conn() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                SELECT id, code, discount_percentage
-                FROM promo_codes
-                WHERE code = ? AND product_id = ? AND is_active = 1
-                AND start_date <= date('now') AND end_date >= date('now')
-                """,
-                (code.upper(), product_id)
-            )
-            promo = cursor.fetchone()
-            return dict(promo) if promo else None
-    except Exception as e:
-        logger.error(f"Error validating promo code {code} for product {product_id}: {e}")
-        return None
+        raise
 
+@ttl_cache(maxsize=32, ttl=SETTINGS_CACHE_TTL)
 def get_setting(key: str) -> str:
     """Retrieve a setting from the database."""
     try:
-        with get_conn() as conn:
+        with get_read_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
+            cursor.execute(SQL_GET_SETTING, (key,))
             row = cursor.fetchone()
             return row['value'] if row else None
     except Exception as e:
         logger.error(f"Error fetching setting {key}: {e}")
-        return None
+        raise
 
 def update_setting(key: str, value: str) -> bool:
     """Update a setting in the database."""
     try:
-        with get_conn() as conn:
+        with get_write_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
                 (key, value)
             )
-            return cursor.rowcount > 0
+        get_setting.cache_clear()
+        return cursor.rowcount > 0
     except Exception as e:
         logger.error(f"Error updating setting {key}: {e}")
         return False
 
+def read_media_file(photo_path: str):
+    """Read a stored media file, or return None if it is missing; meant to run off the event loop."""
+    try:
+        with open(os.path.join(MEDIA_DIR, photo_path), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+# --- Batched Writes ---
+# How long queued profile and join-request rows wait for company before one commit (seconds)
+WRITE_FLUSH_INTERVAL = 0.2
+# Longest wait between retries of a batch that failed to commit (seconds)
+WRITE_RETRY_MAX_DELAY = 10
+# Failed batch commits before rows are written one by one and failing rows are dropped
+WRITE_MAX_ATTEMPTS = 5
+
+# (sql, params) rows waiting for the next batch commit
+_pending_writes = asyncio.Queue()
+# Rows taken off the queue but not committed yet; kept across failed attempts
+_write_batch = []
+# Background task running flush_pending_writes
+_write_batcher = None
+
+def write_pending_rows(batch: list):
+    """Insert queued rows with one executemany per statement inside a single transaction."""
+    rows_by_sql = {}
+    for sql, params in batch:
+        rows_by_sql.setdefault(sql, []).append(params)
+    with get_write_conn() as conn:
+        for sql, rows in rows_by_sql.items():
+            conn.executemany(sql, rows)
+
+def write_rows_individually(batch: list):
+    """Insert queued rows one statement at a time, logging and dropping rows that fail.
+
+    Lock errors still raise: they say nothing about the row and the batch is retried later.
+    """
+    dropped = 0
+    with get_write_conn() as conn:
+        for sql, params in batch:
+            try:
+                conn.execute(sql, params)
+            except sqlite3.Error as e:
+                if isinstance(e, sqlite3.OperationalError) and 'locked' in str(e):
+                    raise
+                logger.error(f"Dropping queued row {params}: {e}")
+                dropped += 1
+    if dropped:
+        logger.warning(f"Committed {len(batch) - dropped} queued rows, dropped {dropped}")
+
+def drain_pending_writes(batch: list) -> list:
+    """Move everything currently queued into batch."""
+    while not _pending_writes.empty():
+        batch.append(_pending_writes.get_nowait())
+    return batch
+
+async def flush_pending_writes():
+    """Commit queued rows in batches, retrying a failed batch with backoff.
+
+    After WRITE_MAX_ATTEMPTS failures the batch is written row by row so a row that
+    can never be inserted is dropped instead of holding back everything queued after it.
+    """
+    delay = WRITE_FLUSH_INTERVAL
+    failures = 0
+    while True:
+        if not _write_batch:
+            _write_batch.append(await _pending_writes.get())
+        await asyncio.sleep(delay)
+        drain_pending_writes(_write_batch)
+        writer = write_pending_rows if failures < WRITE_MAX_ATTEMPTS else write_rows_individually
+        write = run_db(writer, list(_write_batch))
+        try:
+            await asyncio.shield(write)
+        except asyncio.CancelledError:
+            # Let a commit already in progress finish so its rows are not written again at shutdown
+            try:
+                await write
+                _write_batch.clear()
+            except Exception:
+                pass
+            raise
+        except Exception as e:
+            failures += 1
+            delay = min(delay * 2, WRITE_RETRY_MAX_DELAY)
+            logger.error(f"Error writing {len(_write_batch)} queued rows, retrying in {delay}s: {e}")
+            continue
+        logger.debug("Committed %d queued rows", len(_write_batch))
+        _write_batch.clear()
+        delay = WRITE_FLUSH_INTERVAL
+        failures = 0
+
+async def start_write_batcher(application: Application):
+    """Start the batch writer once the application is initialized."""
+    global _write_batcher
+    _write_batcher = asyncio.create_task(flush_pending_writes())
+
+async def flush_remaining_writes(application: Application):
+    """Stop the batch writer and commit its unwritten batch plus whatever is still queued."""
+    if _write_batcher is not None:
+        _write_batcher.cancel()
+        try:
+            await _write_batcher
+        except asyncio.CancelledError:
+            pass
+    batch = drain_pending_writes(_write_batch)
+    if batch:
+        try:
+            write_pending_rows(batch)
+        except Exception as e:
+            logger.error(f"Error writing {len(batch)} queued rows at shutdown, writing them one by one: {e}")
+            write_rows_individually(batch)
+        batch.clear()
+
 # --- Async Wrappers ---
 async def clear_user_cart_async(user_id: int) -> bool:
     try:
-        loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(None, clear_user_cart, user_id)
+        return await run_db(clear_user_cart, user_id)
     except Exception as e:
         logger.error(f"Async error clearing cart for user {user_id}: {e}")
         return False
 
 async def register_user_async(telegram_id: int, username: str = None) -> bool:
-    try:
-        loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(None, register_user, telegram_id, username)
-    except Exception as e:
-        logger.error(f"Async error registering user {telegram_id}: {e}")
-        return False
+    """Queue the profile insert; it is committed with the next batch."""
+    _pending_writes.put_nowait((SQL_REGISTER_USER, (telegram_id, username)))
+    return True
 
 async def save_support_request_async(user_id: int, username: str, content: str) -> int:
     try:
-        loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(None, save_support_request, user_id, username, content)
+        return await run_db(save_support_request, user_id, username, content)
     except Exception as e:
         logger.error(f"Async error saving support request for user {user_id}: {e}")
         raise
 
 async def log_join_request_async(user_id: int, username: str, status: str):
-    try:
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(None, log_join_request, user_id, username, status)
-    except Exception as e:
-        logger.error(f"Async error logging join request for {user_id}: {e}")
+    """Queue the join request log row; it is committed with the next batch."""
+    _pending_writes.put_nowait((SQL_LOG_JOIN_REQUEST, (user_id, username, status)))
 
 async def get_categories_async() -> list:
     try:
-        loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(None, get_categories)
+        return await run_db(get_categories)
     except Exception as e:
         logger.error(f"Async error fetching categories: {e}")
         return []
 
-async def get_promotions_async() -> list:
+async def get_promotions_view_async() -> tuple:
     try:
-        loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(None, get_promotions)
+        return await run_db(get_promotions_view)
     except Exception as e:
         logger.error(f"Async error fetching promotions: {e}")
-        return []
+        return None, []
 
-async def get_products_by_category_async(category_id: int) -> list:
+async def get_category_with_products_async(category_id: int) -> tuple:
     try:
-        loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(None, get_products_by_category, category_id)
+        return await run_db(get_category_with_products, category_id)
     except Exception as e:
-        logger.error(f"Async error fetching products for category {category_id}: {e}")
-        return []
+        logger.error(f"Async error fetching category {category_id} with products: {e}")
+        return None, []
 
-async def get_product_by_id_async(product_id: int) -> dict:
+async def get_product_by_id_async(product_id: int) -> sqlite3.Row:
     try:
-        loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(None, get_product_by_id, product_id)
+        return await run_db(get_product_by_id, product_id)
     except Exception as e:
         logger.error(f"Async error fetching product {product_id}: {e}")
         return None
 
 async def add_product_to_cart_async(user_id: int, product_id: int, promo_code_id: int = None) -> bool:
     try:
-        loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(None, add_product_to_cart, user_id, product_id, promo_code_id)
+        return await run_db(add_product_to_cart, user_id, product_id, promo_code_id)
     except Exception as e:
         logger.error(f"Async error adding product {product_id} to cart for user {user_id}: {e}")
         return False
 
+async def apply_promo_code_to_cart_async(user_id: int, code: str):
+    try:
+        return await run_db(apply_promo_code_to_cart, user_id, code)
+    except Exception as e:
+        logger.error(f"Async error applying promo code {code} to cart of user {user_id}: {e}")
+        return None
+
 async def get_user_cart_async(user_id: int) -> list:
     try:
-        loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(None, get_user_cart, user_id)
+        return await run_db(get_user_cart, user_id)
     except Exception as e:
         logger.error(f"Async error fetching cart for user {user_id}: {e}")
         return []
 
 async def is_blocked_async(user_id: int) -> bool:
     try:
-        loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(None, is_blocked, user_id)
+        return await run_db(is_blocked, user_id)
     except Exception as e:
         logger.error(f"Async error checking if user {user_id} is blocked: {e}")
         return False
 
-async def validate_promo_code_async(code: str, product_id: int) -> dict:
-    try:
-        loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(None, validate_promo_code, code, product_id)
-    except Exception as e:
-        logger.error(f"Async error validating promo code {code} for product {product_id}: {e}")
-        return None
-
 async def get_setting_async(key: str) -> str:
     """Async wrapper for get_setting."""
     try:
-        loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(None, get_setting, key)
+        return await run_db(get_setting, key)
     except Exception as e:
         logger.error(f"Async error fetching setting {key}: {e}")
         return None
@@ -466,26 +737,39 @@ async def get_setting_async(key: str) -> str:
 async def update_setting_async(key: str, value: str) -> bool:
     """Async wrapper for update_setting."""
     try:
-        loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(None, update_setting, key, value)
+        return await run_db(update_setting, key, value)
     except Exception as e:
         logger.error(f"Async error updating setting {key}: {e}")
         return False
 
 # --- Helper Functions ---
+# Permission check results keyed by chat id
+bot_permissions_cache = TTLCache(maxsize=64, ttl=PERMISSIONS_CACHE_TTL)
+
 async def check_bot_permissions(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> bool:
     """Check if the bot has admin permissions to manage join requests."""
+    cached = bot_permissions_cache.get(chat_id)
+    if cached is not None:
+        return cached
     try:
         chat_member = await context.bot.get_chat_member(chat_id=chat_id, user_id=context.bot.id)
         if chat_member.status in ('administrator', 'creator') and chat_member.can_invite_users:
             logger.info(f"Bot has required permissions in chat {chat_id}")
+            bot_permissions_cache[chat_id] = True
             return True
         logger.warning(f"Bot lacks admin or can_invite_users permission in chat {chat_id}")
+        bot_permissions_cache[chat_id] = False
         return False
     except Exception as e:
         logger.error(f"Error checking bot permissions in chat {chat_id}: {e}")
         return False
 
+async def handle_bot_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Forget cached permissions when the bot's membership in a chat changes."""
+    chat_id = update.my_chat_member.chat.id
+    bot_permissions_cache.pop(chat_id, None)
+    logger.debug("Bot membership changed in chat %s, permissions cache cleared", chat_id)
+
 # --- Bot Handlers ---
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command."""
@@ -493,7 +777,10 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.effective_user.username
     logger.info(f"User {user_id} started bot")
 
-    if await is_blocked_async(user_id):
+    blocked, restrict_setting = await asyncio.gather(
+        is_blocked_async(user_id), get_setting_async('restrict_keyboard_to_admins')
+    )
+    if blocked:
         logger.warning(f"Blocked user {user_id} attempted to start bot")
         await update.message.reply_text("❌ Вы заблокированы и не можете использовать бота.")
         return
@@ -504,7 +791,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.warning(f"Failed to register user {user_id}")
 
     is_admin = user_id in ADMIN_IDS
-    restrict_keyboard = await get_setting_async('restrict_keyboard_to_admins') == '1'
+    restrict_keyboard = restrict_setting == '1'
 
     inline_keyboard = [
         [InlineKeyboardButton("📦 Каталог", callback_data='catalog_main')],
@@ -519,7 +806,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         inline_keyboard.append([InlineKeyboardButton(f"🔐 {status_text}", callback_data='toggle_keyboard')])
 
     inline_markup = InlineKeyboardMarkup(inline_keyboard)
-    reply_markup = ReplyKeyboardMarkup(BACK_BUTTON, resize_keyboard=True)
+    reply_markup = BACK_KEYBOARD
     start_message = '🏠 Добро пожаловать! Выберите действие:'
 
     if restrict_keyboard and not is_admin:
@@ -570,12 +857,7 @@ async def show_catalog(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    keyboard = [
-        [InlineKeyboardButton(category['name'], callback_data=f'category_{category["id"]}')]
-        for category in categories
-    ]
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data='back_to_main')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = cached_keyboard('catalog', categories, build_catalog_keyboard)
 
     await query.edit_message_text(
         text="📂 Выберите категорию:",
@@ -594,17 +876,8 @@ async def show_category_products(update: Update, context: ContextTypes.DEFAULT_T
         await query.message.reply_text("❌ Вы заблокированы и не можете просматривать товары.")
         return
 
-    try:
-        with get_conn() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT name FROM categories WHERE id = ?", (category_id,))
-            category = cursor.fetchone()
-            category_name = category['name'] if category else "Неизвестная категория"
-    except Exception as e:
-        logger.error(f"Error fetching category name {category_id}: {e}")
-        category_name = "Неизвестная категория"
-
-    products = await get_products_by_category_async(category_id)
+    category_name, products = await get_category_with_products_async(category_id)
+    category_name = category_name or "Неизвестная категория"
     if not products:
         await query.edit_message_text(
             text=f"В категории '{category_name}' пока нет товаров.",
@@ -612,12 +885,7 @@ async def show_category_products(update: Update, context: ContextTypes.DEFAULT_T
         )
         return
 
-    keyboard = [
-        [InlineKeyboardButton(f"{p['prod_name']} - {int(p['price'])}₽", callback_data=f'product_{p["id"]}')]
-        for p in products
-    ]
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data='catalog_main')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = cached_keyboard(f'category_{category_id}', products, build_category_products_keyboard)
 
     await query.edit_message_text(
         text=f"Товары в категории '{category_name}':",
@@ -655,15 +923,20 @@ async def show_product_details(update: Update, context: ContextTypes.DEFAULT_TYP
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     try:
-        if product['photo_path'] and os.path.exists(os.path.join(MEDIA_DIR, product['photo_path'])):
-            with open(os.path.join(MEDIA_DIR, product['photo_path']), 'rb') as photo:
-                await query.message.reply_photo(
-                    photo=photo,
-                    caption=message,
-                    parse_mode='HTML',
-                    reply_markup=reply_markup
-                )
+        # A known file_id is resent by reference; otherwise upload from disk once and keep its file_id
+        photo = product['user_photo_file_id']
+        if not photo and product['photo_path']:
+            photo = await asyncio.to_thread(read_media_file, product['photo_path'])
+        if photo:
+            sent = await query.message.reply_photo(
+                photo=photo,
+                caption=message,
+                parse_mode='HTML',
+                reply_markup=reply_markup
+            )
             await query.delete_message()
+            if not product['user_photo_file_id']:
+                await run_db(set_product_photo_file_id, product_id, sent.photo[-1].file_id)
         else:
             logger.warning(f"Missing or invalid photo_path for product {product_id}: {product['photo_path']}")
             await query.edit_message_text(text=message, parse_mode='HTML', reply_markup=reply_markup)
@@ -676,28 +949,25 @@ async def show_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     logger.info(f"Showing cart for user {user_id}")
 
-    if await is_blocked_async(user_id):
+    blocked, cart_items = await asyncio.gather(is_blocked_async(user_id), get_user_cart_async(user_id))
+    if blocked:
         await update.message.reply_text("❌ Вы заблокированы и не можете просматривать корзину.")
         return
 
-    cart_items = await get_user_cart_async(user_id)
     if not cart_items:
         text = "🛒 Ваша корзина пуста."
     else:
         message_lines = []
         total_price = 0
         for item in cart_items:
-            price = float(item['price'])
             if item['promo_code_id'] and item['discount_percentage']:
-                discount = item['discount_percentage']
-                discounted_price = price * (1 - discount / 100)
                 message_lines.append(
-                    f"{item['prod_name']} - {int(price)}₽ (-{discount}%: {int(discounted_price)}₽, промокод: {item['code']})"
+                    f"{item['prod_name']} - {int(item['price'])}₽ (-{item['discount_percentage']}%: "
+                    f"{int(item['effective_price'])}₽, промокод: {item['code']})"
                 )
-                total_price += discounted_price
             else:
-                message_lines.append(f"{item['prod_name']} - {int(price)}₽")
-                total_price += price
+                message_lines.append(f"{item['prod_name']} - {int(item['price'])}₽")
+            total_price += item['effective_price']
         text = "🛒 Ваша корзина:\n\n" + "\n".join(message_lines) + f"\n\n💰 Итого: {int(total_price)}₽"
 
     keyboard = []
@@ -720,129 +990,165 @@ async def apply_promo_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     logger.info(f"User {user_id} started applying promo code")
 
-    if await is_blocked_async(user_id):
+    blocked, cart_items = await asyncio.gather(is_blocked_async(user_id), get_user_cart_async(user_id))
+    if blocked:
         await query.message.reply_text("❌ Вы заблокированы и не можете использовать промокоды.")
         return ConversationHandler.END
 
-    cart_items = await get_user_cart_async(user_id)
     if not cart_items:
         await query.message.reply_text("🛒 Ваша корзина пуста. Добавьте товары, чтобы применить промокод.")
         return ConversationHandler.END
 
     await query.message.reply_text(
         "🎟 Введите промокод:",
-        reply_markup=ReplyKeyboardMarkup(BACK_BUTTON, resize_keyboard=True)
+        reply_markup=BACK_KEYBOARD
     )
     return PROMO_CODE_INPUT
 
 async def apply_promo_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle promo code input."""
     user_id = update.effective_user.id
-    code = update.message.text.strip().upper()
+    code = update.message.text.strip()
     logger.info(f"User {user_id} entered promo code: {code}")
 
-    if code == "🔙 Назад":
-        await update.message.reply_text("❌ Применение промокода отменено.", reply_markup=ReplyKeyboardRemove())
-        await start_command(update, context)
-        return ConversationHandler.END
-
     cart_items = await get_user_cart_async(user_id)
     if not cart_items:
-        await update.message.reply_text("🛒 Ваша корзина пуста.", reply_markup=ReplyKeyboardRemove())
+        await update.message.reply_text("🛒 Ваша корзина пуста.", reply_markup=REMOVE_KEYBOARD)
         return ConversationHandler.END
 
-    applied = False
-    for item in cart_items:
-        product_id = item['product_id']
-        promo = await validate_promo_code_async(code, product_id)
-        if promo:
-            with get_conn() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "UPDATE buy SET promo_code_id = ? WHERE user_id = ? AND product_id = ?",
-                    (promo['id'], user_id, product_id)
-                )
-                if cursor.rowcount > 0:
-                    applied = True
-                    logger.info(f"Promo code {code} applied to product {product_id} for user {user_id}")
-                    break
+    # The admin bot only creates Latin letter/digit codes, anything else cannot match
+    if code.isascii() and code.isalnum():
+        code = code.upper()
+        product_id = await apply_promo_code_to_cart_async(user_id, code)
+    else:
+        product_id = None
 
-    if applied:
+    if product_id is not None:
+        logger.info(f"Promo code {code} applied to product {product_id} for user {user_id}")
         await update.message.reply_text(
             f"✅ Промокод {code} успешно применён!",
-            reply_markup=ReplyKeyboardRemove()
+            reply_markup=REMOVE_KEYBOARD
         )
     else:
         await update.message.reply_text(
             "❗ Промокод недействителен или не применим к товарам в корзине.",
-            reply_markup=ReplyKeyboardRemove()
+            reply_markup=REMOVE_KEYBOARD
         )
 
     await show_cart(update, context)
     return ConversationHandler.END
 
+async def prompt_support_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Start a support request by asking the user for their message."""
+    query = update.callback_query
+    await query.answer()
+    user_id = update.effective_user.id
+
+    if await is_blocked_async(user_id):
+        await query.message.reply_text("❌ Вы заблокированы и не можете отправлять запросы поддержки.")
+        return ConversationHandler.END
+
+    await query.message.reply_text(
+        "📩 Напишите ваш вопрос в поддержку:",
+        reply_markup=BACK_KEYBOARD
+    )
+    logger.debug("User %s prompted for support message", user_id)
+    return SUPPORT_MESSAGE_INPUT
+
 async def handle_support_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle incoming text messages to check for support context."""
+    """Handle support message input."""
     user = update.effective_user
     user_id = user.id
     message_text = update.message.text.strip()
-    logger.debug(f"Received message from user {user_id}: '{message_text}'")
+    logger.debug("Received support message from user %s: '%s'", user_id, message_text)
 
     if await is_blocked_async(user_id):
         await update.message.reply_text("❌ Вы заблокированы и не можете отправлять запросы поддержки.")
-        return
+        return ConversationHandler.END
 
-    previous_message = context.user_data.get('last_bot_message', '')
-    is_support_context = previous_message == "📩 Напишите ваш вопрос в поддержку:"
+    if not message_text:
+        logger.warning(f"Empty support message from user {user_id}")
+        await update.message.reply_text(
+            "❗ Пожалуйста, введите текст вашего вопроса или проблемы:",
+            reply_markup=BACK_KEYBOARD
+        )
+        return SUPPORT_MESSAGE_INPUT
 
-    if message_text == "🔙 Назад":
-        logger.info(f"User {user_id} canceled operation via back button")
-        await update.message.reply_text("❌ Операция отменена.", reply_markup=ReplyKeyboardRemove())
-        context.user_data.clear()
+    try:
+        username = f"@{user.username}" if user.username else "Не указан"
+        request_id = await save_support_request_async(
+            user_id=user_id,
+            username=username,
+            content=message_text
+        )
+        await update.message.reply_text(
+            "✅ Ваш запрос успешно отправлен в поддержку. Мы свяжемся с вами вскоре.",
+            reply_markup=REMOVE_KEYBOARD
+        )
+        logger.info(f"Support request #{request_id} from user {user_id} saved successfully")
         await start_command(update, context)
-        return
+        return ConversationHandler.END
+    except Exception as e:
+        logger.error(f"Error saving support request for user {user_id}: {e}")
+        await update.message.reply_text(
+            "❗ Ошибка при отправке запроса. Пожалуйста, попробуйте позже или свяжитесь напрямую с @support_username.",
+            reply_markup=BACK_KEYBOARD
+        )
+        return SUPPORT_MESSAGE_INPUT
 
-    if is_support_context:
-        if not message_text:
-            logger.warning(f"Empty support message from user {user_id}")
-            await update.message.reply_text(
-                "❗ Пожалуйста, введите текст вашего вопроса или проблемы:",
-                reply_markup=ReplyKeyboardMarkup(BACK_BUTTON, resize_keyboard=True)
-            )
-            context.user_data['last_bot_message'] = "❗ Пожалуйста, введите текст вашего вопроса или проблемы:"
-            return
+async def cancel_support(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cancel support message input."""
+    logger.info(f"User {update.effective_user.id} canceled support request")
+    await update.message.reply_text("❌ Операция отменена.", reply_markup=REMOVE_KEYBOARD)
+    await start_command(update, context)
+    return ConversationHandler.END
 
-        try:
-            username = f"@{user.username}" if user.username else "Не указан"
-            request_id = await save_support_request_async(
-                user_id=user_id,
-                username=username,
-                content=message_text
-            )
-            await update.message.reply_text(
-                "✅ Ваш запрос успешно отправлен в поддержку. Мы свяжемся с вами вскоре.",
-                reply_markup=ReplyKeyboardRemove()
+# Welcome texts for approved join requests, filled in per member
+WELCOME_TEMPLATE = (
+    "Добро пожаловать в студию штор «Еврокаскад», @{username}!\n"
+    "Уже более 25 лет мы создаем уют и стиль в вашем доме с помощью качественного текстиля.\n"
+    "От элегантных штор до современных жалюзи и рулонных штор с электроуправлением — мы знаем, "
+    "как подчеркнуть индивидуальность вашего интерьера!\n"
+    "Оставайтесь с нами и следите за новостями!"
+)
+CHANNEL_WELCOME_TEMPLATE = (
+    "Привет, @{username}! 🎉\n"
+    "Спасибо за вступление в канал! Чтобы начать, отправь /start боту: t.me/{bot_username}"
+)
+
+async def send_welcome_message(bot, chat_id: int, user_id: int, user_chat_id: int, username: str):
+    """Welcome an approved member privately, falling back to a channel message."""
+    welcome_message = WELCOME_TEMPLATE.format(username=username)
+
+    # Отправляем приветственное сообщение через user_chat_id
+    try:
+        if user_chat_id:
+            await bot.send_message(
+                chat_id=user_chat_id,
+                text=welcome_message,
+                parse_mode='HTML'
             )
-            logger.info(f"Support request #{request_id} from user {user_id} saved successfully")
-            context.user_data.clear()
-            await start_command(update, context)
-        except Exception as e:
-            logger.error(f"Error saving support request for user {user_id}: {e}")
-            await update.message.reply_text(
-                "❗ Ошибка при отправке запроса. Пожалуйста, попробуйте позже или свяжитесь напрямую с @support_username.",
-                reply_markup=ReplyKeyboardMarkup(BACK_BUTTON, resize_keyboard=True)
+            logger.info(f"Welcome message sent to user {user_id} via user_chat_id {user_chat_id}")
+        else:
+            logger.warning(f"No user_chat_id provided for user {user_id}")
+            raise BadRequest("No user_chat_id available")
+    except (BadRequest, Forbidden) as e:
+        logger.warning(f"Failed to send welcome message to user {user_id}: {e}")
+        channel_message = CHANNEL_WELCOME_TEMPLATE.format(username=username, bot_username=bot.username)
+        try:
+            await bot.send_message(
+                chat_id=chat_id,
+                text=channel_message,
+                parse_mode='HTML'
             )
-            context.user_data['last_bot_message'] = "❗ Ошибка при отправке запроса. Пожалуйста, попробуйте позже или свяжитесь напрямую с @support_username."
-    else:
-        logger.debug(f"Message from user {user_id} not in support context, ignoring")
+            logger.info(f"Sent fallback channel message for user {user_id}")
+        except Exception as channel_e:
+            logger.error(f"Failed to send channel message for user {user_id}: {channel_e}")
+    except Exception as e:
+        logger.error(f"Unexpected error sending welcome message to user {user_id}: {e}")
 
 async def handle_new_channel_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle join requests in the channel."""
-    logger.debug("Received chat_join_request update")
-    if not update.chat_join_request:
-        logger.warning("No chat_join_request in update")
-        return
-
     join_request = update.chat_join_request
     chat = join_request.chat
     user = join_request.from_user
@@ -851,18 +1157,15 @@ async def handle_new_channel_member(update: Update, context: ContextTypes.DEFAUL
     username = user.username or "Пользователь"
     logger.info(f"Join request from {user_id} (@{username}) in chat {chat.id}, user_chat_id: {user_chat_id}")
 
-    # Проверяем, что событие произошло в канале
-    if chat.type != "channel":
-        logger.debug("Ignoring non-channel join request")
-        return
-
-    # Проверяем права бота
-    if not await check_bot_permissions(context, chat.id):
+    # Проверяем права бота и блокировку пользователя одновременно
+    has_permissions, blocked = await asyncio.gather(
+        check_bot_permissions(context, chat.id), is_blocked_async(user_id)
+    )
+    if not has_permissions:
         logger.error(f"Bot lacks permissions to process join requests in chat {chat.id}")
         return
 
-    # Проверяем, не заблокирован ли пользователь
-    if await is_blocked_async(user_id):
+    if blocked:
         logger.warning(f"Blocked user {user_id} attempted to join, rejecting request")
         try:
             await context.bot.decline_chat_join_request(chat_id=chat.id, user_id=user_id)
@@ -883,47 +1186,85 @@ async def handle_new_channel_member(update: Update, context: ContextTypes.DEFAUL
         logger.error(f"Error approving join request for {user_id}: {e}")
         return
 
-    # Приветственное сообщение
-    welcome_message = (
-        f"Добро пожаловать в студию штор «Еврокаскад», @{username}!\n"
-        "Уже более 25 лет мы создаем уют и стиль в вашем доме с помощью качественного текстиля.\n"
-        "От элегантных штор до современных жалюзи и рулонных штор с электроуправлением — мы знаем, "
-        "как подчеркнуть индивидуальность вашего интерьера!\n"
-        "Оставайтесь с нами и следите за новостями!"
+    # Приветственное сообщение отправляем в фоне, чтобы не задерживать следующие заявки
+    context.application.create_task(
+        send_welcome_message(context.bot, chat.id, user_id, user_chat_id, username),
+        update=update
     )
 
+async def clear_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Empty the user's cart and show it again."""
+    query = update.callback_query
+    if await clear_user_cart_async(update.effective_user.id):
+        await query.edit_message_text("✅ Корзина очищена.")
+    else:
+        await query.edit_message_text("❌ Не удалось очистить корзину.")
+    await show_cart(update, context)
 
+async def show_promotions(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show current promotions followed by their images."""
+    query = update.callback_query
+    text, photos = await get_promotions_view_async()
+    if not text:
+        await query.edit_message_text("🎁 На данный момент акций нет.")
+        return
+    await query.edit_message_text(text)
+    # Albums hold 2-10 photos, so a lone trailing photo is sent on its own
+    for i in range(0, len(photos), 10):
+        album = photos[i:i + 10]
+        if len(album) > 1:
+            try:
+                await query.message.reply_media_group(media=album)
+                continue
+            except BadRequest as e:
+                # One bad image rejects the whole album; retry photo by photo so only it is lost
+                logger.warning(f"Promo album rejected, sending images one by one: {e}")
+        for photo in album:
+            try:
+                await query.message.reply_photo(photo=photo.media, caption=photo.caption)
+            except BadRequest as e:
+                logger.error(f"Error sending promo image {photo.media}: {e}")
+
+async def add_to_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Add the product from "add_to_cart_<id>" callback data to the cart."""
+    query = update.callback_query
+    product_id = int(query.data[len('add_to_cart_'):])
+    if await add_product_to_cart_async(update.effective_user.id, product_id):
+        await query.answer("✅ Добавлено в корзину")
+    else:
+        await query.answer("❌ Не удалось добавить в корзину")
 
-    # Отправляем приветственное сообщение через user_chat_id
-    try:
-        if user_chat_id:
-            await context.bot.send_message(
-                chat_id=user_chat_id,
-                text=welcome_message,
-                parse_mode='HTML',
-                reply_markup=reply_markup
-            )
-            logger.info(f"Welcome message sent to user {user_id} via user_chat_id {user_chat_id}")
-        else:
-            logger.warning(f"No user_chat_id provided for user {user_id}")
-            raise BadRequest("No user_chat_id available")
-    except (BadRequest, Forbidden) as e:
-        logger.warning(f"Failed to send welcome message to user {user_id}: {e}")
-        channel_message = (
-            f"Привет, @{username}! 🎉\n"
-            f"Спасибо за вступление в канал! Чтобы начать, отправь /start боту: t.me/{context.bot.username}"
-        )
-        try:
-            await context.bot.send_message(
-                chat_id=chat.id,
-                text=channel_message,
-                parse_mode='HTML'
-            )
-            logger.info(f"Sent fallback channel message for user {user_id}")
-        except Exception as channel_e:
-            logger.error(f"Failed to send channel message for user {user_id}: {channel_e}")
-    except Exception as e:
-        logger.error(f"Unexpected error sending welcome message to user {user_id}: {e}")
+async def toggle_keyboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Let an admin restrict the main keyboard to admins or open it to everyone."""
+    query = update.callback_query
+    if update.effective_user.id not in ADMIN_IDS:
+        await query.message.reply_text("Спасибо за вступление в канал! 🎉")
+        return
+    current_state = await get_setting_async('restrict_keyboard_to_admins')
+    new_state = '0' if current_state == '1' else '1'
+    if await update_setting_async('restrict_keyboard_to_admins', new_state):
+        status_text = "доступна всем" if new_state == '0' else "ограничена для админов"
+        await query.message.reply_text(f"✅ Клавиатура теперь {status_text}.")
+    else:
+        await query.message.reply_text("❌ Ошибка при изменении настроек.")
+    await start_command(update, context)
+
+# Handlers for fixed callback data
+CALLBACK_HANDLERS = {
+    'catalog_main': show_catalog,
+    'back_to_main': start_command,
+    'cart': show_cart,
+    'clear_cart': clear_cart,
+    'promotions': show_promotions,
+    'toggle_keyboard': toggle_keyboard,
+}
+
+# Handlers for "<prefix><id>" callback data, checked in order when there is no exact match
+CALLBACK_PREFIX_HANDLERS = (
+    ('category_', show_category_products),
+    ('product_', show_product_details),
+    ('add_to_cart_', add_to_cart),
+)
 
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle callback queries."""
@@ -937,75 +1278,16 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.message.reply_text("❌ Вы заблокированы и не можете использовать бота.")
         return
 
-    match data:
-        case 'catalog_main':
-            await show_catalog(update, context)
-        case data if data.startswith('category_'):
-            await show_category_products(update, context)
-        case data if data.startswith('product_'):
-            await show_product_details(update, context)
-        case 'back_to_main':
-            await start_command(update, context)
-        case 'cart':
-            await show_cart(update, context)
-        case 'clear_cart':
-            success = await clear_user_cart_async(user_id)
-            if success:
-                await query.edit_message_text("✅ Корзина очищена.")
-            else:
-                await query.edit_message_text("❌ Не удалось очистить корзину.")
-            await show_cart(update, context)
-        case 'promotions':
-            promos = await get_promotions_async()
-            if not promos:
-                await query.edit_message_text("🎁 На данный момент акций нет.")
-                return
-            text = "🎁 Текущие акции:\n\n" + "\n\n".join(
-                f"📌 {p['name']}\n{p['description'] or 'Без описания'}\n🕒 {p['start_date']}–{p['end_date']}"
-                for p in promos
-            )
-            await query.edit_message_text(text)
-            for promo in promos:
-                if promo.get('image_url'):
-                    try:
-                        await query.message.reply_photo(
-                            photo=promo['image_url'],
-                            caption=f"{promo['name']}\n{promo['description'] or ''}"
-                        )
-                    except BadRequest as e:
-                        logger.error(f"Error sending promo image: {e}")
-        case 'support_request':
-            await query.message.reply_text(
-                "📩 Напишите ваш вопрос в поддержку:",
-                reply_markup=ReplyKeyboardMarkup(BACK_BUTTON, resize_keyboard=True)
-            )
-            context.user_data['last_bot_message'] = "📩 Напишите ваш вопрос в поддержку:"
-            logger.debug(f"User {user_id} prompted for support message")
-        case 'apply_promo':
-            return await apply_promo_start(update, context)
-        case data if data.startswith('add_to_cart_'):
-            product_id = int(data.split('_')[-1])
-            if await add_product_to_cart_async(user_id, product_id):
-                await query.answer("✅ Добавлено в корзину")
-            else:
-                await query.answer("❌ Не удалось добавить в корзину")
-        case 'toggle_keyboard':
-            if user_id not in ADMIN_IDS:
-                await query.message.reply_text("Спасибо за вступление в канал! 🎉")
-                return
-            current_state = await get_setting_async('restrict_keyboard_to_admins')
-            new_state = '0' if current_state == '1' else '1'
-            if await update_setting_async('restrict_keyboard_to_admins', new_state):
-                status_text = "доступна всем" if new_state == '0' else "ограничена для админов"
-                await query.message.reply_text(f"✅ Клавиатура теперь {status_text}.")
-            else:
-                await query.message.reply_text("❌ Ошибка при изменении настроек.")
-            await start_command(update, context)
+    handler = CALLBACK_HANDLERS.get(data)
+    if handler is None:
+        handler = next((h for prefix, h in CALLBACK_PREFIX_HANDLERS if data.startswith(prefix)), None)
+    if handler is not None:
+        return await handler(update, context)
 
 async def cancel_promo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel promo code input."""
     logger.info(f"User {update.effective_user.id} canceled promo code input")
-    await update.message.reply_text("❌ Применение промокода отменено.", reply_markup=ReplyKeyboardRemove())
+    await update.message.reply_text("❌ Применение промокода отменено.", reply_markup=REMOVE_KEYBOARD)
     context.user_data.clear()
     await start_command(update, context)
     return ConversationHandler.END
@@ -1021,41 +1303,90 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         msg = update.message or update.callback_query.message
         await msg.reply_text("❗ Произошла ошибка. Попробуйте снова.")
 
+# --- Handlers ---
+class ChannelJoinRequestHandler(ChatJoinRequestHandler):
+    """Handle join requests to channels only; group join requests are never dispatched."""
+
+    def check_update(self, update: object) -> bool:
+        return super().check_update(update) and update.chat_join_request.chat.type == 'channel'
+
 # --- Main ---
 def main():
     """Run the bot."""
     try:
         init_db()
-        application = Application.builder().token(TOKEN).build()
+        application = (
+            Application.builder()
+            .token(TOKEN)
+            .request(HTTPXRequest(
+                connection_pool_size=API_POOL_SIZE,
+                pool_timeout=POOL_TIMEOUT,
+                connect_timeout=10,
+                read_timeout=20
+            ))
+            .get_updates_request(HTTPXRequest(connection_pool_size=UPDATES_POOL_SIZE))
+            .post_init(start_write_batcher)
+            .post_shutdown(flush_remaining_writes)
+            .build()
+        )
 
         # Promo code conversation handler
         promo_handler = ConversationHandler(
             entry_points=[CallbackQueryHandler(apply_promo_start, pattern='^apply_promo$')],
             states={
-                PROMO_CODE_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, apply_promo_code)],
+                PROMO_CODE_INPUT: [MessageHandler(TEXT_NOCMD & ~BACK_FILTER, apply_promo_code)],
             },
             fallbacks=[
                 CommandHandler('cancel', cancel_promo),
-                MessageHandler(filters.Regex('^🔙 Назад$'), cancel_promo)
+                MessageHandler(BACK_FILTER, cancel_promo)
             ],
             per_chat=True,
             per_user=True,
-            per_message=True,
+            allow_reentry=True,
             name='promo_conversation'
         )
 
+        # Support request conversation handler; only text sent after the prompt reaches it
+        support_handler = ConversationHandler(
+            entry_points=[CallbackQueryHandler(prompt_support_request, pattern='^support_request$')],
+            states={
+                SUPPORT_MESSAGE_INPUT: [MessageHandler(TEXT_NOCMD & ~BACK_FILTER, handle_support_message)],
+            },
+            fallbacks=[
+                CommandHandler('cancel', cancel_support),
+                MessageHandler(BACK_FILTER, cancel_support)
+            ],
+            per_chat=True,
+            per_user=True,
+            allow_reentry=True,
+            name='support_conversation'
+        )
+
         # Handlers
         application.add_handler(CommandHandler('start', start_command))
         application.add_handler(CommandHandler('cart', show_cart))
-        application.add_handler(CallbackQueryHandler(button))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_support_message))
-        application.add_handler(MessageHandler(filters.Regex('^🔙 Назад$'), start_command))
-        application.add_handler(ChatJoinRequestHandler(handle_new_channel_member))
         application.add_handler(promo_handler)
+        application.add_handler(support_handler)
+        application.add_handler(CallbackQueryHandler(button))
+        application.add_handler(MessageHandler(BACK_FILTER, start_command))
+        application.add_handler(ChannelJoinRequestHandler(handle_new_channel_member))
+        application.add_handler(ChatMemberHandler(handle_bot_member_update, ChatMemberHandler.MY_CHAT_MEMBER))
         application.add_error_handler(error_handler)
 
-        logger.info("Starting bot polling")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        if WEBHOOK_URL:
+            # Uses the python-telegram-bot[webhooks] extra from req.txt; meant to run behind a reverse proxy
+            logger.info(f"Starting bot webhook on port {WEBHOOK_PORT}")
+            application.run_webhook(
+                listen='0.0.0.0',
+                port=WEBHOOK_PORT,
+                url_path=TOKEN,
+                webhook_url=f"{WEBHOOK_URL}/{TOKEN}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES
+            )
+        else:
+            logger.info("Starting bot polling")
+            application.run_polling(allowed_updates=Update.ALL_TYPES)
     except Exception as e:
         logger.error(f"Failed to start bot: {e}")
         raise